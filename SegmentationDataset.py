@@ -453,9 +453,17 @@ def get_custom_pairs(folder, split='train'):
     return img_paths, mask_paths
 
 
+def make_loader(dataset, batch_size, shuffle, drop_last, workers, pin, rank=-1):
+    # DataLoader for dataset. In DDP (rank != -1) every rank gets its own shard from a DistributedSampler, the same number
+    # of batches per rank, reshuffled by loader.sampler.set_epoch()
+    sampler = data.DistributedSampler(dataset, shuffle=shuffle) if rank != -1 else None
+    return data.DataLoader(dataset, batch_size=batch_size, drop_last=drop_last, shuffle=shuffle and sampler is None,
+                           sampler=sampler, num_workers=workers, pin_memory=pin)
+
+
 def get_citys_loader(root=os.path.expanduser('data/citys/'), split="train", mode="train",  
                      base_size=1024, crop_size=(1024, 512),
-                     batch_size=32, workers=4, pin=True):
+                     batch_size=32, workers=4, pin=True, rank=-1):
     if mode == "train":
         input_transform = transforms.Compose([
             transforms.ColorJitter(brightness=0.45, contrast=0.45,
@@ -472,15 +480,12 @@ def get_citys_loader(root=os.path.expanduser('data/citys/'), split="train", mode
                                transform=input_transform,
                                base_size=base_size, crop_size=crop_size, low=0.65, high=3, sample_std=25)
 
-    loader = data.DataLoader(dataset, batch_size=batch_size,
-                             drop_last=  False, shuffle=True if mode == "train" else False,
-                             num_workers=workers, pin_memory=pin)
-    return loader
+    return make_loader(dataset, batch_size, mode == "train", False, workers, pin, rank)
 
 
 def get_citysbdd_loader(root=os.path.expanduser('data/citys/'), split="train", mode="train",  
                      base_size=1024, crop_size=(1024, 512),
-                     batch_size=32, workers=4, pin=True):
+                     batch_size=32, workers=4, pin=True, rank=-1):
     if mode == "train":
         input_transform = transforms.Compose([
             transforms.ColorJitter(brightness=0.4, contrast=0.4,
@@ -497,16 +502,13 @@ def get_citysbdd_loader(root=os.path.expanduser('data/citys/'), split="train", m
                                transform=input_transform,
                                base_size=base_size, crop_size=crop_size, low=0.65, high=2, sample_std=40)
 
-    loader = data.DataLoader(dataset, batch_size=batch_size,
-                             drop_last=True if mode == "train" else False, shuffle=True if mode == "train" else False,
-                             num_workers=workers, pin_memory=pin)
-    return loader
+    return make_loader(dataset, batch_size, mode == "train", mode == "train", workers, pin, rank)
 
 
 
 def get_custom_loader(root=os.path.expanduser('data/lentic_water/'), split="train", mode="train",  
                      base_size=1024,  # crop_size=(1024, 1024), 
-                     batch_size=32, workers=4, pin=True):
+                     batch_size=32, workers=4, pin=True, rank=-1):
     if mode == "train":
         input_transform = transforms.Compose([
             transforms.ColorJitter(brightness=0.4, contrast=0.4,
@@ -523,10 +525,7 @@ def get_custom_loader(root=os.path.expanduser('data/lentic_water/'), split="trai
                                transform=input_transform,
                                base_size=base_size, crop_size=(base_size, base_size), low=0.75, high=1.5, sample_std=35)
 
-    loader = data.DataLoader(dataset, batch_size=batch_size,
-                             drop_last=True if mode == "train" else False, shuffle=True if mode == "train" else False,
-                             num_workers=workers, pin_memory=pin)
-    return loader
+    return make_loader(dataset, batch_size, mode == "train", mode == "train", workers, pin, rank)
 
 
 if __name__ == "__main__":
@@ -1,4 +1,6 @@
 import argparse
+import json
+import math
 import time
 from pathlib import Path
 import os
@@ -8,10 +10,12 @@ import torch.backends.cudnn as cudnn
 from numpy import random
 import torch.nn.functional as F
 
-from models.experimental import attempt_load
-from utils.datasets import LoadStreams, LoadImages
+from models.experimental import attempt_load, BackendModel
+from models.yolo import Detect
+from utils.datasets import LoadStreams, LoadImages, LoadImageBatches, tile_image
 from utils.general import check_img_size, check_requirements, check_imshow, non_max_suppression, apply_classifier, \
     scale_coords, xyxy2xywh, strip_optimizer, set_logging, increment_path
+from utils.pipeline import Pipeline
 from utils.plots import plot_one_box
 from utils.torch_utils import select_device, load_classifier, time_synchronized
 import numpy as np
@@ -37,15 +41,42 @@ def label2image(pred, COLORMAP=Lenticwater_COLORMAP):
     X = pred.astype('int32')
     return colormap[X, :]
 
+def seg_upsample(seg, shape):
+    # Nearest-neighbour upsample of a (h,w) uint8 class map to shape (h,w), on seg.device
+    h, w = shape[:2]
+    ys = ((torch.arange(h, device=seg.device) * 2 + 1) * seg.shape[0] // (2 * h))  # nearest source row per output row
+    xs = ((torch.arange(w, device=seg.device) * 2 + 1) * seg.shape[1] // (2 * w))
+    return seg[ys[:, None], xs]
+
+def seg2image(seg, im0, lut):
+    # Upsample a (h,w) uint8 class map to im0 size (nearest), colorize with a uint8 BGR lut and blend on seg.device
+    cls = seg_upsample(seg, im0.shape)  # (h,w) uint8
+    mask = lut[cls.long()]  # (h,w,3) uint8
+    img = torch.from_numpy(im0).to(seg.device)
+    dst = ((mask.short() * 2 + img.short() * 3 + 2) // 5).byte()  # == cv2.addWeighted(mask, 0.4, im0, 0.6, 0)
+    return cls, mask.cpu().numpy(), dst.cpu().numpy()
+
+def mask2rle(m):
+    # COCO uncompressed RLE {'size': [h, w], 'counts': [...]} of a binary (h,w) mask, column-major, 0-run first
+    pixels = m.T.ravel()
+    bounds = np.concatenate([[0], np.flatnonzero(pixels[1:] != pixels[:-1]) + 1, [pixels.size]])
+    counts = np.diff(bounds).tolist()
+    return {'size': list(m.shape), 'counts': [0] + counts if pixels[0] else counts}
+
 def detect(save_img=False):
     source, weights, view_img, save_txt, imgsz = opt.source, opt.weights, opt.view_img, opt.save_txt, opt.img_size
     save_img = not opt.nosave and not source.endswith('.txt')  # save inference images
     webcam = source.isnumeric() or source.endswith('.txt') or source.lower().startswith(
         ('rtsp://', 'rtmp://', 'http://', 'https://'))
+    batched = not webcam and opt.batch_size > 1 and not opt.tile  # group same-shape images/frames into one forward pass
 
     # Directories
     save_dir = Path(increment_path(Path(opt.project) / opt.name, exist_ok=opt.exist_ok))  # increment run
     (save_dir / 'labels' if save_txt else save_dir).mkdir(parents=True, exist_ok=True)  # make dir
+    seg_format = set(opt.seg_format)
+    tasks = None if seg_format else {'det'}  # skip the seg head when no seg output is wanted
+    if 'png' in seg_format:
+        (save_dir / 'seg').mkdir(parents=True, exist_ok=True)  # class-index PNGs
     if opt.submit:
         sub_dir = str(save_dir) + "/results/"
         if not os.path.exists(sub_dir):
@@ -57,11 +88,21 @@ def detect(save_img=False):
     half = device.type != 'cpu'  # half precision only supported on CUDA
     # half = False  
     # Load model
-    model = attempt_load(weights, map_location=device)  # load FP32 model
+    model = attempt_load(weights, map_location=device, threads=opt.ort_threads)  # load FP32 model (*.onnx: ORT)
+    half &= any(True for _ in model.parameters())  # ONNX Runtime runs FP32 on CPU
     stride = int(model.stride.max())  # model stride
     imgsz = check_img_size(imgsz, s=stride)  # check img_size
+    if opt.tile:
+        opt.tile = check_img_size(opt.tile, s=stride)  # tile size multiple of stride
     if half:
         model.half()  # to FP16
+    augment = [(float(t.rstrip('lrud')), {'lr': 3, 'ud': 2}.get(t[-2:])) for t in opt.tta] if opt.tta else opt.augment
+    if opt.prefilter:
+        for m in model.modules():
+            if isinstance(m, Detect):
+                m.prefilter = opt.conf_thres, opt.topk  # decode only the top-k candidates above --conf-thres
+    if opt.backend != 'eager':
+        model = BackendModel(model, opt.backend)  # TorchScript / torch.compile, built per input shape
 
     # Second-stage classifier
     classify = False
@@ -70,16 +111,19 @@ def detect(save_img=False):
         modelc.load_state_dict(torch.load('weights/resnet101.pt', map_location=device)['model']).to(device).eval()
 
     # Set Dataloader
-    vid_path, vid_writer, s_writer = None, None, None
     if webcam:
-        view_img = check_imshow()
+        view_img = view_img and check_imshow()  # headless unless --view-img
         cudnn.benchmark = True  # set True to speed up constant image size inference
                                 
                                 
-        dataset = LoadStreams(source, img_size=imgsz, stride=stride)
+        dataset = LoadStreams(source, img_size=imgsz, stride=stride, policy=opt.stream_policy, ready=opt.ready_batch,
+                              headless=not opt.view_img, processes=opt.stream_processes)
     else:
         cudnn.benchmark = False
         dataset = LoadImages(source, img_size=imgsz, stride=stride)  
+        dataset.verbose = False  # progress is printed together with results
+        if batched:
+            dataset = LoadImageBatches(dataset, batch_size=opt.batch_size)
 
     if opt.submit or opt.save_as_video:  
         cudnn.benchmark = True
@@ -87,12 +131,30 @@ def detect(save_img=False):
     # Get names and colors
     names = model.module.names if hasattr(model, 'module') else model.names
     colors = [[random.randint(0, 255) for _ in range(3)] for _ in names]
+    lut = torch.tensor(Lenticwater_COLORMAP, dtype=torch.uint8, device=device)[:, [2, 1, 0]]  # BGR colormap
 
     # Run inference
-    if device.type != 'cpu':
-        model(torch.zeros(1, 3, imgsz, imgsz).to(device).type_as(next(model.parameters())))  # run once
-    t0 = time.time()
-    for path, img, im0s, vid_cap in dataset:
+    if half or opt.backend != 'eager':
+        with torch.no_grad():
+            model(torch.zeros(1, 3, imgsz, imgsz, device=device, dtype=torch.half if half else torch.float))  # run once
+    vid_path, vid_writer, s_writer = None, None, None
+
+    def decode():
+        # Stage 0: read and letterbox, snapshot per-image dataset state before the loader moves on
+        for path, img, im0s, vid_cap in dataset:
+            items = []  # (path, print string, im0, frame, vid_cap, mode) per image
+            for i in range(img.shape[0] if img.ndim == 4 else 1):
+                if webcam:  # batch_size >= 1
+                    items.append((path[i], '%g: ' % dataset.ready[i], im0s[i].copy(), dataset.count, None, dataset.mode))
+                elif batched:  # per-item state recorded by LoadImageBatches
+                    items.append((path[i], dataset.s[i], im0s[i], dataset.frames[i], vid_cap[i], dataset.modes[i]))
+                else:
+                    items.append((path, dataset.s, im0s, getattr(dataset, 'frame', 0), vid_cap, dataset.mode))
+            yield img, items
+
+    def infer(x):
+        # Stage 1: forward pass and NMS on the device
+        img, items = x
         img = torch.from_numpy(img).to(device)
         img = img.half() if half else img.float()  # uint8 to fp16/32
         img /= 255.0  # 0 - 255 to 0.0 - 1.0
@@ -102,32 +164,86 @@ def detect(save_img=False):
         # Inference
         with torch.no_grad():
             t1 = time_synchronized()
-            out = model(img, augment=opt.augment)
-            pred = out[0][0]
-            seg = out[1]  # [0]
-        # Apply NMS
-            pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms)
+            out = model(img, augment=augment, tasks=tasks)
+            seg = out[1]  # (bs,n_segcls,h,w), None if the seg head was skipped
+            if opt.fast_seg and seg is not None:
+                seg = seg.argmax(1).byte()  # (bs,h,w) class map at network resolution, kept on device
+            # Apply NMS
+            if out[0] is None:  # segmentation-only model
+                pred = [torch.zeros((0, 6), device=device)] * img.shape[0]
+            else:
+                pred = non_max_suppression(out[0][0], opt.conf_thres, opt.iou_thres, classes=opt.classes,
+                                           agnostic=opt.agnostic_nms)
             t2 = time_synchronized()
 
-        # Apply Classifier
-        if classify:
-            pred = apply_classifier(pred, modelc, img, im0s)
+            # Apply Classifier
+            if classify:
+                pred = apply_classifier(pred, modelc, img, [x[2] for x in items])
+        return [img.shape[2:]] * len(items), items, pred, seg, t2 - t1
 
-        # Process detections
-        for i, det in enumerate(pred):  # detections per image
-            if webcam:  # batch_size >= 1
-                p, s, im0, frame = path[i], '%g: ' % i, im0s[i].copy(), dataset.count
-            else:
-                p, s, im0, frame = path, '', im0s, getattr(dataset, 'frame', 0)
+    def infer_tiled(x):
+        # Stage 1 for --tile: run each image at native resolution as batches of overlapping tiles, merge boxes with
+        # NMS in image coordinates and blend seg logits with weights that fall off towards the tile borders
+        _, items = x
+        shapes, pred, seg = [], [], []
+        t1 = time_synchronized()
+        for item in items:
+            im0 = item[2]
+            tiles, offsets = tile_image(im0, opt.tile, opt.tile_overlap, stride)
+            tiles = torch.from_numpy(np.ascontiguousarray(tiles[..., ::-1].transpose(0, 3, 1, 2))).to(device)
+            dets, logits, weight = [], None, None
+            for j in range(0, len(tiles), opt.tile_batch):
+                xb = tiles[j:j + opt.tile_batch]
+                xb = (xb.half() if half else xb.float()) / 255.0  # uint8 to fp16/32, 0 - 255 to 0.0 - 1.0
+                with torch.no_grad():
+                    out = model(xb, augment=augment, tasks=tasks)
+                for k, (ox, oy) in enumerate(offsets[j:j + opt.tile_batch]):
+                    if out[0] is not None:
+                        d = out[0][0][k]  # (n,5+nc) xywh in tile pixels
+                        d[:, 0] += ox
+                        d[:, 1] += oy
+                        dets.append(d)
+                    if out[1] is not None:
+                        sk = out[1][k].float()  # (n_segcls,th,tw)
+                        th, tw = sk.shape[1:]
+                        r = opt.tile // tw  # seg output stride
+                        if logits is None:
+                            hp, wp = max(y for _, y in offsets) + opt.tile, max(x for x, _ in offsets) + opt.tile
+                            logits = torch.zeros((sk.shape[0], hp // r, wp // r), device=device)
+                            weight = torch.zeros((hp // r, wp // r), device=device)
+                            a = [torch.arange(n, device=device) + 0.5 for n in (th, tw)]
+                            wy, wx = [torch.minimum(ai, n - ai) for ai, n in zip(a, (th, tw))]
+                            wk = wy[:, None] * wx[None]  # tent weights, highest in the tile centre
+                        logits[:, oy // r:oy // r + th, ox // r:ox // r + tw] += sk * wk
+                        weight[oy // r:oy // r + th, ox // r:ox // r + tw] += wk
+            if dets:
+                pred += non_max_suppression(torch.cat(dets, 0)[None], opt.conf_thres, opt.iou_thres, classes=opt.classes,
+                                            agnostic=opt.agnostic_nms)
+            else:  # segmentation-only model
+                pred.append(torch.zeros((0, 6), device=device))
+            if logits is not None:
+                segi = (logits / weight)[:, :math.ceil(im0.shape[0] / r), :math.ceil(im0.shape[1] / r)]  # crop padding
+                seg.append(segi.argmax(0).byte() if opt.fast_seg else segi)
+            shapes.append(im0.shape[:2])
+        t2 = time_synchronized()
+        return shapes, items, pred, seg or None, t2 - t1
 
+    def post(x):
+        # Stage 2: rescale boxes, draw and render segmentation per image
+        shapes, items, pred, seg, dt = x
+        if seg is None and seg_format:  # detection-only model, e.g. strip_optimizer(tasks={'det'})
+            print(f"WARNING: model has no segmentation head, skipping --seg-format {' '.join(sorted(seg_format))}")
+            seg_format.clear()
+        results = []
+        for i, (det, (p, s, im0, frame, cap, mode)) in enumerate(zip(pred, items)):  # detections per image
             p = Path(p)  # to Path
-            save_path = str(save_dir / p.name)  # img.jpg
-            txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # img.txt
-            s += '%gx%g ' % img.shape[2:]  # print string
+            txt_path = str(save_dir / 'labels' / p.stem) + ('' if mode == 'image' else f'_{frame}')  # img.txt
+            s += '%gx%g ' % tuple(shapes[i])  # print string
             gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
+            lines = []  # label lines for txt_path
             if len(det):
                 # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape).round()
+                det[:, :4] = scale_coords(shapes[i], det[:, :4], im0.shape).round()
 
                 # Print results
                 for c in det[:, -1].unique():
@@ -139,20 +255,58 @@ def detect(save_img=False):
                     if save_txt:  # Write to file
                         xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
                         line = (cls, *xywh, conf) if opt.save_conf else (cls, *xywh)  # label format
-                        with open(txt_path + '.txt', 'a') as f:
-                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
+                        lines.append(('%g ' * len(line)).rstrip() % line + '\n')
 
                     if save_img or view_img:  # Add bbox to image
                         label = f'{names[int(cls)]} {conf:.2f}'
                         plot_one_box(xyxy, im0, label=label, color=colors[int(cls)], line_thickness=3)
 
-            # Print time (inference + NMS)
-            print(f'{s}Done. ({t2 - t1:.5f}s)')
             # seg = seg[0]
-            seg = F.interpolate(seg, (im0.shape[0], im0.shape[1]), mode='bilinear', align_corners=True)[0]
+            cls, mask, dst = None, None, None
+            if opt.fast_seg:  # only uint8 images leave the device
+                if 'overlay' in seg_format:
+                    cls, mask, dst = seg2image(seg[i], im0, lut)
+                elif seg_format:
+                    cls = seg_upsample(seg[i], im0.shape)
+            elif seg_format:
+                with torch.no_grad():
+                    segi = F.interpolate(seg[i][None], (im0.shape[0], im0.shape[1]), mode='bilinear', align_corners=True)[0]
+                cls = segi.max(axis=0)[1]
+
+                if 'overlay' in seg_format:
+                    mask = label2image(cls.cpu().numpy(), Lenticwater_COLORMAP)[:, :, ::-1]
+                    dst = cv2.addWeighted(mask, 0.4, im0, 0.6, 0)
 
-            mask = label2image(seg.max(axis=0)[1].cpu().numpy(), Lenticwater_COLORMAP)[:, :, ::-1]
-            dst = cv2.addWeighted(mask, 0.4, im0, 0.6, 0)
+            # Machine-readable segmentation: class-index map and/or a JSONL record per image
+            segmap, record = None, None
+            if 'png' in seg_format:
+                segmap = cls.byte().cpu().numpy()
+            if seg_format & {'rle', 'coverage'}:
+                area = torch.bincount(cls.flatten().long(), minlength=len(Lenticwater_Class)).tolist()
+                record = {'image': p.name, 'frame': frame, 'size': list(im0.shape[:2]),
+                          'coverage': {Lenticwater_Class[c]: round(a / cls.numel(), 6) for c, a in enumerate(area) if a}}
+                if 'rle' in seg_format:
+                    m = cls.byte().cpu().numpy() if segmap is None else segmap
+                    record['rle'] = {Lenticwater_Class[c]: mask2rle(m == c) for c, a in enumerate(area) if a}
+            results.append((p, f'{s}Done. ({dt:.5f}s)', im0, mask, dst, txt_path, lines, cap, mode, segmap, record))
+        return results
+
+    def write(results):
+        # Stage 3: print and save, in source order
+        nonlocal vid_path, vid_writer, s_writer
+        for p, s, im0, mask, dst, txt_path, lines, cap, mode, segmap, record in results:
+            # Print time (inference + NMS)
+            print(s)
+            if lines:
+                with open(txt_path + '.txt', 'a') as f:
+                    f.writelines(lines)
+            if segmap is not None:
+                cv2.imwrite(str(save_dir / 'seg' / Path(txt_path).name) + '.png', segmap)
+            if record is not None:
+                with open(save_dir / 'seg.jsonl', 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+            if dst is None:  # overlay rendering skipped
+                dst = im0
 
             # Stream results
             #if view_img:
@@ -167,21 +321,23 @@ def detect(save_img=False):
             #    result = trainid2id(seg.max(axis=0)[1].cpu().numpy(), Cityscapes_IDMAP)
             #    cv2.imwrite(sub_path, result)
             # Save results (image with detections)
+            save_path = str(save_dir / p.name)  # img.jpg
             if save_img:
-                if dataset.mode == 'image':
+                if mode == 'image':
                     cv2.imwrite(save_path, im0)
-                    cv2.imwrite(save_path[:-4]+"_mask"+save_path[-4:], mask)
-                    cv2.imwrite(save_path[:-4]+"_dst"+save_path[-4:], dst)
+                    if mask is not None:
+                        cv2.imwrite(save_path[:-4]+"_mask"+save_path[-4:], mask)
+                        cv2.imwrite(save_path[:-4]+"_dst"+save_path[-4:], dst)
 
                 else: # 'video' or 'stream'
                     if vid_path != save_path:  # new video
                         vid_path = save_path
                         if isinstance(vid_writer, cv2.VideoWriter):
                             vid_writer.release()  # release previous video writer
-                        if vid_cap:  # video
-                            fps = vid_cap.get(cv2.CAP_PROP_FPS)
-                            w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                            h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                        if cap:  # video
+                            fps = cap.get(cv2.CAP_PROP_FPS)
+                            w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+                            h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
                         else:  # stream
                             fps, w, h = 30, dst.shape[1], dst.shape[0]
                             save_path += '.mp4'
@@ -192,19 +348,37 @@ def detect(save_img=False):
                     fps, w, h = 30, dst.shape[1], dst.shape[0]
                     s_writer = cv2.VideoWriter(str(save_dir)+"out.mp4", cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
                 s_writer.write(dst)
+        return len(results)
+
+    t0, seen = time.time(), 0
+    if opt.pipeline:  # overlap decode, inference, post-processing and writing in worker threads
+        pipeline = Pipeline(decode(), [('infer', infer_tiled if opt.tile else infer, 1), ('post', post, opt.post_workers), ('write', write, 1)],
+                            maxsize=opt.queue_size)
+        for n in pipeline:
+            seen += n
+        print(pipeline.stats())
+    else:
+        for x in decode():
+            seen += write(post((infer_tiled if opt.tile else infer)(x)))
+    if webcam:
+        print(dataset.stats())
+
     if save_txt or save_img:
         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
         print(f"Results saved to {save_dir}{s}")
+    if isinstance(vid_writer, cv2.VideoWriter):
+        vid_writer.release()
     if s_writer != None:
         s_writer.release()
-    print(f'Done. ({time.time() - t0:.3f}s)')
-
+    dt = time.time() - t0
+    print(f'Done. ({dt:.3f}s, {seen / dt:.1f} images/s)')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--weights', nargs='+', type=str, default='yolov5s.pt', help='model.pt path(s)')
     parser.add_argument('--source', type=str, default='data/images', help='source')  # file/folder, 0 for webcam
     parser.add_argument('--img-size', type=int, default=640, help='inference size (pixels)')
+    parser.add_argument('--batch-size', type=int, default=1, help='batch same-shape images/video frames per forward')
     parser.add_argument('--conf-thres', type=float, default=0.25, help='object confidence threshold')
     parser.add_argument('--iou-thres', type=float, default=0.45, help='IOU threshold for NMS')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
@@ -215,12 +389,31 @@ if __name__ == '__main__':
     parser.add_argument('--classes', nargs='+', type=int, help='filter by class: --class 0, or --class 0 2 3')
     parser.add_argument('--agnostic-nms', action='store_true', help='class-agnostic NMS')
     parser.add_argument('--augment', action='store_true', help='augmented inference')
+    parser.add_argument('--tta', nargs='+', help='augmented inference transforms (scale, lr/ud flip): --tta 1 1lr 0.83')
     parser.add_argument('--update', action='store_true', help='update all models')
     parser.add_argument('--project', default='runs/detect', help='save results to project/name')
     parser.add_argument('--name', default='exp', help='save results to project/name')
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
     parser.add_argument('--save-as-video', action='store_true', help='save same size images as a video')
     parser.add_argument('--submit', action='store_true', help='get submit file in folder submit')
+    parser.add_argument('--fast-seg', action='store_true', help='seg argmax at network size, upsample and colorize on device')
+    parser.add_argument('--seg-format', nargs='*', default=['overlay'], choices=['overlay', 'png', 'rle', 'coverage'],
+                        help='seg outputs: overlay (_mask/_dst JPEGs), png (class-index), rle and/or coverage (seg.jsonl)')
+    parser.add_argument('--stream-policy', nargs='+', default=['every-4'],
+                        help='per-stream frame policy: latest, every-k or time-t (seconds), one or one per stream')
+    parser.add_argument('--ready-batch', action='store_true', help='batch only streams with a new frame, as they arrive')
+    parser.add_argument('--stream-processes', action='store_true', help='decode streams in processes via shared memory')
+    parser.add_argument('--tile', type=int, default=0, help='tiled inference at native resolution with this tile size')
+    parser.add_argument('--tile-overlap', type=float, default=0.2, help='--tile overlap fraction')
+    parser.add_argument('--tile-batch', type=int, default=8, help='--tile tiles per forward pass')
+    parser.add_argument('--backend', default='eager', choices=['eager', 'jit', 'compile'],
+                        help='*.pt inference backend: eager, frozen TorchScript or torch.compile')
+    parser.add_argument('--ort-threads', nargs=2, type=int, default=[0, 0], help='*.onnx intra/inter-op threads, 0 auto')
+    parser.add_argument('--prefilter', action='store_true', help='decode only candidates above --conf-thres in Detect()')
+    parser.add_argument('--topk', type=int, default=1000, help='--prefilter candidates per image, 0 all (eager only)')
+    parser.add_argument('--pipeline', action='store_true', help='run decode/infer/post-process/write stages in threads')
+    parser.add_argument('--post-workers', type=int, default=2, help='post-process threads for --pipeline')
+    parser.add_argument('--queue-size', type=int, default=4, help='bounded queue size between --pipeline stages')
     opt = parser.parse_args()
     print(opt)
     check_requirements(exclude=('pycocotools', 'thop'))
@@ -9,6 +9,7 @@ from pathlib import Path
 
 import torch
 
+from models.experimental import BackendModel
 from models.yolo import Model
 from utils.general import check_requirements, set_logging
 from utils.google_utils import attempt_download
@@ -55,13 +56,14 @@ def create(name, pretrained, channels, classes, autoshape):
         raise Exception(s) from e
 
 
-def custom(path_or_model='path/to/model.pt', autoshape=True):
+def custom(path_or_model='path/to/model.pt', autoshape=True, backend='eager'):
     """YOLOv5-custom model https://github.com/ultralytics/yolov5
 
     Arguments (3 options):
         path_or_model (str): 'path/to/model.pt'
         path_or_model (dict): torch.load('path/to/model.pt')
         path_or_model (nn.Module): torch.load('path/to/model.pt')['model']
+        backend (str): 'eager', 'jit' (frozen TorchScript) or 'compile' (torch.compile), see BackendModel
 
     Returns:
         pytorch model
@@ -73,9 +75,11 @@ def custom(path_or_model='path/to/model.pt', autoshape=True):
     hub_model = Model(model.yaml).to(next(model.parameters()).device)  # create
     hub_model.load_state_dict(model.float().state_dict())  # load state_dict
     hub_model.names = model.names  # class names
+    device = select_device('0' if torch.cuda.is_available() else 'cpu')  # default to GPU if available
+    if backend != 'eager':
+        hub_model = BackendModel(hub_model.to(device).fuse().eval(), backend)  # built per input shape on first use
     if autoshape:
         hub_model = hub_model.autoshape()  # for file/URI/PIL/cv2/np inputs and NMS
-    device = select_device('0' if torch.cuda.is_available() else 'cpu')  # default to GPU if available
     return hub_model.to(device)
 
 
@@ -293,6 +293,39 @@ class FFM(nn.Module):  # FeatureFusionModule
         feat_out = feat_atten + feat
         return feat_out
 
+    def reparam(self):
+        # Deployment rewrite: feat * atten + feat as one multiply, feat * (atten + 1) with the add on the (n,c,1,1) map
+        self.forward = self.mergeforward
+
+    def mergeforward(self, fspfcp):
+        fcat = torch.cat(fspfcp, dim=1) if self.is_cat else fspfcp
+        feat = self.convblk(fcat)
+        return feat * (self.channel_attention(feat) + 1)
+
+
+def merge_branches(convs):
+    # Merge fused 1x1 Conv() modules that share an input into one wider nn.Conv2d + activation, outputs in list order
+    assert all(not hasattr(m, 'bn') and m.conv.kernel_size == (1, 1) and m.conv.stride == (1, 1) for m in convs), \
+        'fuse() 1x1 Conv() layers first'
+    w, b = torch.cat([m.conv.weight for m in convs]), torch.cat([m.conv.bias for m in convs])
+    conv = nn.Conv2d(w.shape[1], w.shape[0], 1, bias=True).requires_grad_(False).to(w.device)
+    conv.weight.copy_(w)
+    conv.bias.copy_(b)
+    return nn.Sequential(conv, convs[0].act)
+
+
+def split_projection(m, c):
+    # Split a fused 1x1 Conv() projection of cat([..., g]) into a conv over the leading channels and a bias-free conv
+    # over the last c (global branch g), so g can be projected at 1x1 and broadcast instead of upsampled and concatenated
+    assert not hasattr(m, 'bn') and m.conv.kernel_size == (1, 1), 'fuse() 1x1 Conv() projection first'
+    w = m.conv.weight
+    linear = nn.Conv2d(w.shape[1] - c, w.shape[0], 1, bias=True).requires_grad_(False).to(w.device)
+    linear.weight.copy_(w[:, :-c])
+    linear.bias.copy_(m.conv.bias)
+    glob = nn.Conv2d(c, w.shape[0], 1, bias=False).requires_grad_(False).to(w.device)
+    glob.weight.copy_(w[:, -c:])
+    return linear, glob
+
 
 class ASPP(nn.Module):  # ASPP
     def __init__(self, in_planes, out_planes, d=[3, 6, 9], has_globel=True, map_reduce=4):
@@ -338,6 +371,16 @@ class ASPP(nn.Module):  # ASPP
             out = self.ConvLinear(torch.cat([x0,x1,x2,x3,x4],1))
             return out
 
+    def reparam(self):
+        # Deployment rewrite after fuse(): global branch projected at 1x1 and broadcast-added
+        if self.has_globel:
+            self.linear, self.glob = split_projection(self.ConvLinear, self.hid)
+            self.forward = self.mergeforward
+
+    def mergeforward(self, x):
+        y = torch.cat([self.branch0(x), self.branch1(x), self.branch2(x), self.branch3(x)], 1)
+        return self.ConvLinear.act(self.linear(y) + self.glob(self.branch4(x)))
+
 
 class ASPPs(nn.Module): 
     def __init__(self, in_planes, out_planes, d=[3, 6, 9], has_globel=True, map_reduce=4):
@@ -387,6 +430,22 @@ class ASPPs(nn.Module):
             out = self.ConvLinear(torch.cat([x0,x1,x2,x3,x4],1))
             return out
 
+    def reparam(self):
+        # Deployment rewrite after fuse(): the four leading 1x1 convs as one, global branch projected at 1x1
+        self.stem = merge_branches([self.branch0[0], self.branch1[0], self.branch2[0], self.branch3[0]])
+        self.branch0, self.branch1, self.branch2, self.branch3 = [b[1:] for b in (self.branch0, self.branch1,
+                                                                                  self.branch2, self.branch3)]
+        if self.has_globel:
+            self.linear, self.glob = split_projection(self.ConvLinear, self.hid)
+        self.forward = self.mergeforward
+
+    def mergeforward(self, x):
+        x0, x1, x2, x3 = [b(t) for b, t in zip((self.branch0, self.branch1, self.branch2, self.branch3),
+                                                self.stem(x).chunk(4, 1))]
+        if not self.has_globel:
+            return self.ConvLinear(torch.cat([x0,x1,x2,x3],1))
+        return self.ConvLinear.act(self.linear(torch.cat([x0,x1,x2,x3],1)) + self.glob(self.branch4(x)))
+
 
 class DAPPM(nn.Module):
     
@@ -524,6 +583,23 @@ class RFB1(nn.Module):
             out = self.Fusion(torch.cat([x0,x1,x2,x3,x4],1))
             return out
 
+    def reparam(self):
+        # Deployment rewrite after fuse(): the four leading 1x1 convs as one, global branch projected at 1x1
+        c = self.branch0[0].conv.out_channels
+        self.stem = merge_branches([self.branch0[0], self.branch1[0], self.branch2[0], self.branch3[0]])
+        self.branch0, self.branch1, self.branch2, self.branch3 = [b[1:] for b in (self.branch0, self.branch1,
+                                                                                  self.branch2, self.branch3)]
+        if self.has_globel:
+            self.linear, self.glob = split_projection(self.Fusion, c)
+        self.forward = self.mergeforward
+
+    def mergeforward(self, x):
+        x0, x1, x2, x3 = [b(t) for b, t in zip((self.branch0, self.branch1, self.branch2, self.branch3),
+                                                self.stem(x).chunk(4, 1))]
+        if not self.has_globel:
+            return self.Fusion(torch.cat([x0,x1,x2,x3],1))
+        return self.Fusion.act(self.linear(torch.cat([x0,x1,x2,x3],1)) + self.glob(self.branch4(x)))
+
 
 
 class RFB2(nn.Module):  
@@ -569,6 +645,25 @@ class RFB2(nn.Module):
             out = self.ConvLinear(torch.cat([x0,x1,x2,x3,x4],1))
         return out
 
+    def reparam(self):
+        # Deployment rewrite after fuse(): branch0[0] and branch3 (1x1 on x) as one conv, global branch projected at 1x1
+        c = self.branch3[0].conv.out_channels
+        self.stem = merge_branches([self.branch0[0], self.branch3[0]])
+        self.branch0 = self.branch0[1:]
+        del self.branch3
+        if self.has_globel:
+            self.linear, self.glob = split_projection(self.ConvLinear, c)
+        self.forward = self.mergeforward
+
+    def mergeforward(self, x):
+        x0, x3 = self.stem(x).chunk(2, 1)
+        x0 = self.branch0(x0)
+        x1 = self.branch1(x0)
+        x2 = self.branch2(x1)
+        if not self.has_globel:
+            return self.ConvLinear(torch.cat([x0,x1,x2,x3],1))
+        return self.ConvLinear.act(self.linear(torch.cat([x0,x1,x2,x3],1)) + self.glob(self.branch4(x2)))
+
 
 class PyramidPooling(nn.Module):
     """
@@ -598,6 +693,23 @@ class PyramidPooling(nn.Module):
         return torch.cat((x, feat1, feat2, feat3, feat4, ), 1)
 
 
+class AdaptiveAvgPool2d(nn.Module):
+    # Export-friendly nn.AdaptiveAvgPool2d(): per-bin slices and means, so ONNX export works with dynamic height/width
+    def __init__(self, output_size):
+        super(AdaptiveAvgPool2d, self).__init__()
+        self.output_size = (output_size, output_size) if isinstance(output_size, int) else tuple(output_size)
+
+    def forward(self, x):
+        h, w = x.shape[-2:]
+        oh, ow = self.output_size
+        rows = []
+        for i in range(oh):  # bin [floor(i * h / oh), ceil((i + 1) * h / oh)), as in F.adaptive_avg_pool2d()
+            y0, y1 = i * h // oh, ((i + 1) * h + oh - 1) // oh
+            rows.append(torch.cat([x[..., y0:y1, j * w // ow:((j + 1) * w + ow - 1) // ow].mean((2, 3), keepdim=True)
+                                   for j in range(ow)], 3))
+        return torch.cat(rows, 2)
+
+
 class Focus(nn.Module):  
     # Focus wh information into c-space  
     def __init__(self, c1, c2, k=1, s=1, p=None, g=1, act=True):  # ch_in, ch_out, kernel, stride, padding, groups
@@ -719,21 +831,30 @@ class autoShape(nn.Module):
 
         with amp.autocast(enabled=p.device.type != 'cpu'):
             # Inference
-            y = self.model(x, augment, profile)[0]  # forward
+            y, seg = self.model(x, augment, profile)  # forward, (det, seg) outputs
+            y = y[0] if isinstance(y, tuple) else y  # inference output of Detect() is (z, x)
             t.append(time_synchronized())
 
             # Post-process
             y = non_max_suppression(y, conf_thres=self.conf, iou_thres=self.iou, classes=self.classes)  # NMS
             for i in range(n):
                 scale_coords(shape1, y[i][:, :4], shape0[i])
+            masks = [None] * n  # (h,w) uint8 class maps
+            if seg is not None:  # argmax at inference size, remove letterbox padding, nearest resize to image size
+                seg = seg.argmax(1).byte()
+                for i, s in enumerate(shape0):
+                    g = min(shape1[0] / s[0], shape1[1] / s[1])  # gain
+                    top, left = round((shape1[0] - s[0] * g) / 2), round((shape1[1] - s[1] * g) / 2)
+                    c = seg[i:i + 1, top:top + round(s[0] * g), left:left + round(s[1] * g)]
+                    masks[i] = F.interpolate(c[None].float(), size=s, mode='nearest')[0, 0].byte()
 
             t.append(time_synchronized())
-            return Detections(imgs, y, files, t, self.names, x.shape)
+            return Detections(imgs, y, files, t, self.names, x.shape, masks)
 
 
 class Detections:  
     # detections class for YOLOv5 inference results
-    def __init__(self, imgs, pred, files, times=None, names=None, shape=None):
+    def __init__(self, imgs, pred, files, times=None, names=None, shape=None, seg=None):
         super(Detections, self).__init__()
         d = pred[0].device  # device
         gn = [torch.tensor([*[im.shape[i] for i in [1, 0, 1, 0]], 1., 1.], device=d) for im in imgs]  # normalizations
@@ -746,8 +867,10 @@ class Detections:
         self.xyxyn = [x / g for x, g in zip(self.xyxy, gn)]  # xyxy normalized
         self.xywhn = [x / g for x, g in zip(self.xywh, gn)]  # xywh normalized
         self.n = len(self.pred)  # number of images (batch size)
+        self.times = times  # profiling times
         self.t = tuple((times[i + 1] - times[i]) * 1000 / self.n for i in range(3))  # timestamps (ms)
         self.s = shape  # inference BCHW shape
+        self.seg = seg or [None] * self.n  # list of (h,w) uint8 segmentation class maps at image size
 
     def display(self, pprint=False, show=False, save=False, render=False, save_dir=''):
         colors = color_list()
@@ -801,9 +924,10 @@ class Detections:
 
     def tolist(self):
         # return a list of Detections objects, i.e. 'for result in results.tolist():'
-        x = [Detections([self.imgs[i]], [self.pred[i]], self.names, self.s) for i in range(self.n)]
+        x = [Detections([self.imgs[i]], [self.pred[i]], [self.files[i]], self.times, self.names, self.s, [self.seg[i]])
+             for i in range(self.n)]
         for d in x:
-            for k in ['imgs', 'pred', 'xyxy', 'xyxyn', 'xywh', 'xywhn']:
+            for k in ['imgs', 'pred', 'xyxy', 'xyxyn', 'xywh', 'xywhn', 'seg']:
                 setattr(d, k, getattr(d, k)[0])  # pop out of list
         return x
 
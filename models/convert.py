@@ -0,0 +1,128 @@
+"""Rewrites a *.pt checkpoint into an equivalent, faster backbone graph
+
+Focus() (four strided slices, cat, k x k conv) becomes one 2k x 2k stride-2 Conv() with the weights rearranged, and
+SPP(k=(5, 9, 13)) pooling, also inside C3SPP(), becomes the cascaded SPPF(k=5) form. The model.yaml of the checkpoint
+is updated to match. Outputs before and after are compared and both are benchmarked.
+
+Usage:
+    $ export PYTHONPATH="$PWD" && python models/convert.py --weights ./weights/best.pt --img-size 640
+"""
+
+import argparse
+import sys
+import time
+from copy import deepcopy
+
+sys.path.append('./')  # to run '$ python *.py' files in subdirectories
+
+import torch
+import torch.nn as nn
+
+from models.common import Conv, Focus, SPP, SPPF, C3SPP
+from utils.general import set_logging
+from utils.torch_utils import select_device
+
+
+def focus2conv(focus):
+    # Returns the Conv() of focus with its k x k conv over the 4 space-to-depth slices as a 2k x 2k conv of stride 2s
+    # over the image: slice (dy, dx) channel c tap (a, b) is image channel c tap (2a + dy, 2b + dx)
+    m, c = focus.conv, focus.conv.conv
+    assert c.groups == 1, 'grouped Focus() not supported'
+    c2, c4, k, _ = c.weight.shape
+    c1 = c4 // 4
+    w = c.weight.new_zeros(c2, c1, 2 * k, 2 * k)
+    for g, (dy, dx) in enumerate(((0, 0), (1, 0), (0, 1), (1, 1))):  # Focus() slice order
+        w[:, :, dy::2, dx::2] = c.weight[:, g * c1:(g + 1) * c1]
+    m.conv = nn.Conv2d(c1, c2, 2 * k, 2 * c.stride[0], 2 * c.padding[0], bias=c.bias is not None).to(c.weight)
+    m.conv.weight.data = w
+    if c.bias is not None:
+        m.conv.bias.data = c.bias.data
+    return m
+
+
+def spp2sppf(spp):
+    # Returns SPPF() with the convs of spp, max pools k, 2k-1, 3k-2 == 1, 2, 3 cascaded k pools
+    k = [m.kernel_size for m in spp.m]
+    assert len(k) == 3 and k[1] == 2 * k[0] - 1 and k[2] == 3 * k[0] - 2, f'SPP(k={k}) has no SPPF() equivalent'
+    m = SPPF(spp.cv1.conv.in_channels, spp.cv2.conv.out_channels, k[0])
+    m.cv1, m.cv2 = spp.cv1, spp.cv2
+    return m
+
+
+def convert(model):
+    # Rewrites Focus() and SPP() layers of model in place, model.yaml included. Returns the indices of changed layers
+    cfg = model.yaml['backbone'] + model.yaml['head']  # layer definitions, shared with model.yaml
+    changed = []
+    for i, m in enumerate(model.model):
+        if type(m) is Focus:
+            new = focus2conv(m)
+            c2, k, s, p = (cfg[i][3] + [1, 1, None])[:4]
+            cfg[i][2:] = ['Conv', [c2, 2 * k, 2 * s, 2 * (k // 2 if p is None else p)]]
+        elif type(m) is SPP:
+            new = spp2sppf(m)
+            cfg[i][2:] = ['SPPF', [cfg[i][3][0], m.m[0].kernel_size]]
+        else:
+            for c in m.modules():
+                if type(c) is C3SPP and type(c.m) is SPP:
+                    c.m = spp2sppf(c.m)
+                    changed.append(i)
+            continue
+        new.i, new.f, new.np = m.i, m.f, m.np  # attach index, 'from' index, number params
+        new.type = 'models.common.' + type(new).__name__
+        model.model[i] = new
+        changed.append(i)
+    return sorted(set(changed))
+
+
+def benchmark(model, img, n=10):
+    # Returns mean forward time (ms) of model on img and of each of its layers
+    dt = [0.] * len(model.model)
+    pre = lambda m, x: setattr(m, '_t', time.time())
+    post = lambda m, x, y: dt.__setitem__(m.i, dt[m.i] + time.time() - m._t)
+    hooks = [h for m in model.model for h in (m.register_forward_pre_hook(pre), m.register_forward_hook(post))]
+    with torch.no_grad():
+        model(img)  # warmup
+        dt = [0.] * len(model.model)
+        t = time.time()
+        for _ in range(n):
+            model(img)
+        t = time.time() - t
+    for h in hooks:
+        h.remove()
+    return t / n * 1E3, [x / n * 1E3 for x in dt]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default='./yolov5s.pt', help='weights path')
+    parser.add_argument('--img-size', type=int, default=640, help='verification and benchmark size (pixels)')
+    parser.add_argument('--device', default='cpu', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    opt = parser.parse_args()
+    print(opt)
+    set_logging()
+    device = select_device(opt.device)
+
+    # Convert and verify each of model and ema, fused FP32
+    ckpt = torch.load(opt.weights, map_location=device)
+    img = torch.rand(1, 3, opt.img_size, opt.img_size).to(device)
+    for key in 'model', 'ema':
+        if ckpt.get(key):
+            original = deepcopy(ckpt[key]).float().fuse().eval()
+            changed = convert(ckpt[key])
+            model = deepcopy(ckpt[key]).float().fuse().eval()
+            with torch.no_grad():
+                (d0, _), s0 = original(img)
+                (d1, _), s1 = model(img)
+            print(f"{key}: converted layers {changed}, "
+                  f"max abs diff: detections {(d0 - d1).abs().max():.3g}, seg logits {(s0 - s1).abs().max():.3g}")
+    f = opt.weights.replace('.pt', '_sppf.pt')  # filename
+    torch.save(ckpt, f)
+    print(f'Converted checkpoint saved as {f}')
+
+    # Benchmark, model and ema share the architecture
+    (t0, l0), (t1, l1) = benchmark(original, img), benchmark(model, img)
+    print(('%12s' * 4) % ('layer', 'before ms', 'after ms', 'saved'))
+    for i in changed:
+        print(('%12s' + '%12.2f' * 2 + '%11.1f%%') % (f'{i} {model.model[i].type.split(".")[-1]}', l0[i], l1[i],
+                                                      100 * (1 - l1[i] / l0[i])))
+    print(('%12s' + '%12.2f' * 2 + '%11.1f%%') % ('model', t0, t1, 100 * (1 - t1 / t0)))
@@ -1,11 +1,19 @@
 # YOLOv5 experimental modules
 
+import ast
+import hashlib
+import os
+from pathlib import Path
+
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+import torchvision
 
-from models.common import Conv, DWConv
+from models.common import Conv, DWConv, autoShape
 from utils.google_utils import attempt_download
+from utils.torch_utils import quantize_conv2d, copy_attr
 
 
 class CrossConv(nn.Module):
@@ -100,23 +108,200 @@ class Ensemble(nn.ModuleList):
     def __init__(self):
         super(Ensemble, self).__init__()
 
-    def forward(self, x, augment=False):
+    def forward(self, x, augment=False, tasks=None):
         y = []
         for module in self:
-            y.append(module(x, augment)[0])
+            y.append(module(x, augment, tasks=tasks)[0])
         # y = torch.stack(y).max(0)[0]  # max ensemble
         # y = torch.stack(y).mean(0)  # mean ensemble
         y = torch.cat(y, 1)  # nms ensemble
         return y, None  # inference, train output
 
 
-def attempt_load(weights, map_location=None):
+class OnnxModel(nn.Module):
+    # ONNX Runtime (CPU) backend for a models/export.py multitask export, called like Model: returns [(det, None), seg]
+    def __init__(self, w, threads=(0, 0)):
+        super(OnnxModel, self).__init__()
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads, options.inter_op_num_threads = threads  # 0 for the onnxruntime default
+        self.session = onnxruntime.InferenceSession(w, options, providers=['CPUExecutionProvider'])
+        self.outputs = [x.name for x in self.session.get_outputs()]  # 'detections', 'seg_logits'
+        meta = self.session.get_modelmeta().custom_metadata_map
+        self.stride = torch.tensor(ast.literal_eval(meta.get('stride', '[32]')), dtype=torch.float)
+        nc = int(meta.get('nc', 80))
+        self.names = ast.literal_eval(meta['names']) if 'names' in meta else [str(i) for i in range(nc)]
+
+    def forward(self, x, augment=False, profile=False, tasks=None):
+        y = dict(zip(self.outputs, self.session.run(self.outputs, {'images': x.cpu().float().numpy()})))
+        det, seg = [torch.from_numpy(y[k]).to(x.device) if k in y else None for k in ('detections', 'seg_logits')]
+        return [(det, None) if det is not None else None, seg]
+
+
+class End2End(nn.Module):
+    """ Deployment graph around a traced multitask core: raw frames in, final results out
+
+    Input is a (b,h,w,3) uint8 BGR batch of frames of any size. It is letterboxed to size x size in the graph
+    (BGR to RGB, /255, bilinear resize, 114 padding) and run through core, which maps a (b,3,size,size) float batch to
+    (decoded Detect() output, seg logits). Returns
+        detections (b,max_det,6) float [xyxy, conf, cls] in frame pixels, zero padded, sorted by conf
+        counts (b,) int64 valid detections per frame
+        seg (b,h,w) uint8 class map at frame resolution
+    Scripted for TorchScript and for ONNX export, so frame size and batch size stay dynamic.
+    """
+
+    def __init__(self, core, size=640, conf_thres=0.25, iou_thres=0.45, max_det=300, agnostic=False):
+        super(End2End, self).__init__()
+        self.core = core
+        self.size = size
+        self.conf_thres = conf_thres
+        self.iou_thres = iou_thres
+        self.max_det = max_det
+        self.agnostic = agnostic
+
+    def forward(self, x):
+        b, h, w = x.shape[0], x.shape[1], x.shape[2]
+        s = self.size
+
+        # Letterbox, as utils.datasets.letterbox(auto=False)
+        m = max(h, w)  # ratio r = s / m, integer arithmetic keeps exported slice/resize sizes int64
+        nh, nw = (2 * h * s + m) // (2 * m), (2 * w * s + m) // (2 * m)  # round(h * r), round(w * r)
+        top, left = (s - nh) // 2, (s - nw) // 2
+        img = x.flip(3).permute(0, 3, 1, 2).float() / 255.0  # BGR to RGB, HWC to CHW, 0 - 1
+        img = F.interpolate(img, size=(nh, nw), mode='bilinear', align_corners=False)
+        img = F.pad(img, [left, s - nw - left, top, s - nh - top], value=114 / 255.0)
+        det, seg = self.core(img)
+
+        # Batched NMS, best class per box: one nms() call with boxes offset by image and class
+        conf, j = (det[..., 5:] * det[..., 4:5]).max(2)  # (b,n) conf = obj_conf * cls_conf
+        bi, ni = (conf > self.conf_thres).nonzero().unbind(1)
+        xy, wh = det[bi, ni, :2], det[bi, ni, 2:4]
+        box = torch.cat((xy - wh / 2, xy + wh / 2), 1)  # xywh to xyxy
+        conf, j = conf[bi, ni], j[bi, ni]
+        c = bi * (det.shape[2] - 4) + (j + 1) * int(not self.agnostic)  # per image (and class) offset index
+        i = torchvision.ops.nms(box + c[:, None].float() * 4096, conf, self.iou_thres)  # sorted by conf
+        bi = bi[i]
+        onehot = (bi[:, None] == torch.arange(b, device=x.device)).long()  # (k,b)
+        rank = (onehot.cumsum(0) * onehot).sum(1) - 1  # position of each kept box within its image
+        k = rank < self.max_det
+        onehot, bi, rank, i = onehot[k], bi[k], rank[k], i[k]
+
+        # Rescale boxes to frames, scatter into (b,max_det,6)
+        pad = torch.tensor([left, top, left, top], device=x.device, dtype=box.dtype)
+        limit = torch.tensor([w, h, w, h], device=x.device, dtype=box.dtype)
+        box = torch.min(((box[i] - pad) * m / s).clamp(min=0), limit)
+        out = torch.zeros(b, self.max_det, 6, device=x.device, dtype=box.dtype)
+        out[bi, rank] = torch.cat((box, conf[i, None], j[i, None].to(box.dtype)), 1)
+        counts = onehot.sum(0)
+
+        # Seg class map, letterbox removed, nearest resize to frames
+        seg = seg.argmax(1, keepdim=True)[:, :, top:top + nh, left:left + nw]
+        seg = F.interpolate(seg.float(), size=(h, w), mode='nearest')[:, 0].to(torch.uint8)
+        return out, counts, seg
+
+
+class BackendModel(nn.Module):
+    """ Runs a fused Model through an optimised backend, called like Model: returns [(det, None), seg]
+
+    backend='jit' traces and freezes (constant-folds the weights into) one TorchScript module per input
+    (shape, dtype, device, tasks) and caches it in cache (runs/backend) under the hash of the model weights.
+    backend='compile' torch.compile()s the model, with the inductor cache in cache/inductor (runs/backend/inductor
+    unless TORCHINDUCTOR_CACHE_DIR is set). Removes the per-layer Python overhead of
+    Model.forward_once(). Each new input is warmed up on first use. Calls with augment/profile or autograd enabled,
+    and inputs that fail to build, run eager.
+    """
+
+    def __init__(self, model, backend='jit', cache='runs/backend', warmup=2):
+        super(BackendModel, self).__init__()
+        assert any(True for _ in model.parameters()), \
+            f'--backend {backend} requires *.pt FP32/FP16 weights, use --backend eager for ONNX and INT8 models'
+        self.model = model.eval()
+        self.backend = backend
+        self.cache = Path(cache)
+        self.warmup = warmup
+        self.stride, self.names = model.stride, model.names
+        h = hashlib.sha256()
+        for k, v in model.state_dict().items():
+            if isinstance(v, torch.Tensor):
+                v = v.int_repr() if v.is_quantized else v
+                h.update(k.encode() + v.detach().cpu().numpy().tobytes())
+        self.hash = h.hexdigest()[:16]  # weights hash
+        self.runners = {}  # (shape, dtype, device, tasks): callable, None for eager
+        if backend == 'compile':
+            os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', str(self.cache.resolve() / 'inductor'))
+            self.compiled = torch.compile(self.model)
+
+    def build(self, x, tasks):
+        # Returns a runner for inputs like x
+        if self.backend == 'compile':
+            runner = lambda x: self.compiled(x, tasks=tasks)
+        else:
+            tag = '-'.join(sorted(tasks)) if tasks else 'all'
+            f = self.cache / f"{self.hash}_{tag}_{'x'.join(map(str, x.shape))}_{str(x.dtype)[6:]}_{x.device.type}.pt"
+            if f.exists():
+                ts = torch.jit.load(str(f), map_location=x.device)
+            else:
+                ts = torch.jit.freeze(torch.jit.trace(_Outputs(self.model, tasks).eval(), x, check_trace=False))
+                f.parent.mkdir(parents=True, exist_ok=True)
+                ts.save(str(f))
+
+            def runner(x):
+                det, seg = ts(x)
+                return [(det, None) if det.numel() else None, seg if seg.numel() else None]
+
+        with torch.no_grad():
+            for _ in range(self.warmup):  # JIT profiling runs / compilation
+                runner(x)
+        return runner
+
+    def forward(self, x, augment=False, profile=False, tasks=None):
+        if augment or profile or torch.is_grad_enabled():
+            return self.model(x, augment, profile, tasks=tasks)
+        key = tuple(x.shape), x.dtype, x.device, tuple(sorted(tasks or ()))
+        if key not in self.runners:
+            try:
+                self.runners[key] = self.build(x, tasks)
+            except Exception as e:
+                print(f'WARNING: {self.backend} backend failed for input {tuple(x.shape)}, running eager: {e}')
+                self.runners[key] = None
+        runner = self.runners[key]
+        return self.model(x, tasks=tasks) if runner is None else runner(x)
+
+    def autoshape(self):  # add autoShape module
+        m = autoShape(self)  # wrap model
+        copy_attr(m, self.model, include=('yaml', 'nc', 'hyp', 'names', 'stride'), exclude=())  # copy attributes
+        return m
+
+
+class _Outputs(nn.Module):
+    # Model inference output [(det, x), seg] as a traceable (det, seg) tuple, skipped heads as empty tensors
+    def __init__(self, model, tasks=None):
+        super(_Outputs, self).__init__()
+        self.model = model
+        self.tasks = tasks
+
+    def forward(self, x):
+        det, seg = self.model(x, tasks=self.tasks)
+        empty = x.new_zeros(0)
+        return det[0] if det is not None else empty, seg if seg is not None else empty
+
+
+def attempt_load(weights, map_location=None, tasks=None, threads=(0, 0)):
     # Loads an ensemble of models weights=[a,b,c] or a single model weights=[a] or weights=a
+    # tasks={'det'} or {'seg'} prunes the layers the other head needs, *.onnx weights run in ONNX Runtime with
+    # threads=(intra_op, inter_op)
     model = Ensemble()
     for w in weights if isinstance(weights, list) else [weights]:
+        if str(w).endswith('.onnx'):
+            model.append(OnnxModel(w, threads))
+            continue
         attempt_download(w)
         ckpt = torch.load(w, map_location=map_location)  # load
-        model.append(ckpt['ema' if ckpt.get('ema') else 'model'].float().fuse().eval())  # FP32 model
+        m = ckpt['ema' if ckpt.get('ema') else 'model'].float().fuse().eval()  # FP32 model
+        if ckpt.get('int8'):  # INT8 model from models/quantize.py, CPU only
+            m = quantize_conv2d(m, engine=ckpt['int8']['engine'])
+            m.load_state_dict(ckpt['int8']['state_dict'])
+        model.append(m.select_tasks(tasks) if tasks else m)
 
     # Compatibility updates
     for m in model.modules():
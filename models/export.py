@@ -2,9 +2,13 @@
 
 Usage:
     $ export PYTHONPATH="$PWD" && python models/export.py --weights ./weights/yolov5s.pt --img 640 --batch 1
+
+With --end2end, also exports *.end2end.torchscript.pt and *.end2end.onnx, deployment graphs that take raw uint8 BGR
+frames (batch, height, width, 3) of any size and return final (detections, counts, seg) results, see End2End().
 """
 
 import argparse
+import inspect
 import sys
 import time
 
@@ -14,11 +18,22 @@ import torch
 import torch.nn as nn
 
 import models
-from models.experimental import attempt_load
+from models.experimental import attempt_load, OnnxModel, End2End
 from utils.activations import Hardswish, SiLU
 from utils.general import set_logging, check_img_size
 from utils.torch_utils import select_device
 
+class MultitaskOutputs(nn.Module):
+    # Flattens Model inference output [(det, x), seg] to the two exported outputs (detections, seg_logits)
+    def __init__(self, model):
+        super(MultitaskOutputs, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        (det, _), seg = self.model(x)
+        return det, seg
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--weights', type=str, default='./yolov5s.pt', help='weights path')  # from yolov5/models/
@@ -26,6 +41,12 @@ if __name__ == '__main__':
     parser.add_argument('--batch-size', type=int, default=1, help='batch size')
     parser.add_argument('--dynamic', action='store_true', help='dynamic ONNX axes')
     parser.add_argument('--grid', action='store_true', help='export Detect() layer grid')
+    parser.add_argument('--reparam', action='store_true', help='merge parallel seg head branches before export')
+    parser.add_argument('--end2end', action='store_true', help='also export letterbox, NMS and seg argmax graphs')
+    parser.add_argument('--conf-thres', type=float, default=0.25, help='--end2end object confidence threshold')
+    parser.add_argument('--iou-thres', type=float, default=0.45, help='--end2end IOU threshold for NMS')
+    parser.add_argument('--max-det', type=int, default=300, help='--end2end maximum detections per image')
+    parser.add_argument('--agnostic-nms', action='store_true', help='--end2end class-agnostic NMS')
     parser.add_argument('--device', default='cpu', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     opt = parser.parse_args()
     opt.img_size *= 2 if len(opt.img_size) == 1 else 1  # expand
@@ -36,6 +57,8 @@ if __name__ == '__main__':
     # Load PyTorch model
     device = select_device(opt.device)
     model = attempt_load(opt.weights, map_location=device)  # load FP32 model
+    if opt.reparam:
+        model.reparam()  # fewer, wider seg head convs
     labels = model.names
 
     # Checks
@@ -55,6 +78,9 @@ if __name__ == '__main__':
                 m.act = SiLU()
         # elif isinstance(m, models.yolo.Detect):
         #     m.forward = m.forward_export  # assign forward (optional)
+        for n, c in m.named_children():
+            if isinstance(c, nn.AdaptiveAvgPool2d) and c.output_size not in (1, (1, 1)):
+                setattr(m, n, models.common.AdaptiveAvgPool2d(c.output_size))  # ONNX, any (dynamic) input size
     model.model[-1].export = not opt.grid  # set Detect() layer grid export
     y = model(img)  # dry run
 
@@ -68,25 +94,90 @@ if __name__ == '__main__':
     except Exception as e:
         print('TorchScript export failure: %s' % e)
 
-    # ONNX export
+    # ONNX export, multitask: decoded Detect() output and seg logits
     try:
         import onnx
 
         print('\nStarting ONNX export with onnx %s...' % onnx.__version__)
         f = opt.weights.replace('.pt', '.onnx')  # filename
-        torch.onnx.export(model, img, f, verbose=False, opset_version=12, input_names=['images'],
-                          output_names=['classes', 'boxes'] if y is None else ['output'],
+        model.model[-1].export = False  # decoded detections (grid in graph)
+        model.eval()  # undo Detect() export training flag
+        model.model[-1].onnx_dynamic = opt.dynamic  # grids from the input shape
+        kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+        torch.onnx.export(MultitaskOutputs(model).eval(), img, f, verbose=False, opset_version=12, input_names=['images'],
+                          output_names=['detections', 'seg_logits'],
                           dynamic_axes={'images': {0: 'batch', 2: 'height', 3: 'width'},  # size(1,3,640,640)
-                                        'output': {0: 'batch', 2: 'y', 3: 'x'}} if opt.dynamic else None)
+                                        'detections': {0: 'batch', 1: 'anchors'},  # size(1,25200,5+nc)
+                                        'seg_logits': {0: 'batch', 2: 'height', 3: 'width'}} if opt.dynamic else None,
+                          **kwargs)
 
         # Checks
         onnx_model = onnx.load(f)  # load onnx model
         onnx.checker.check_model(onnx_model)  # check onnx model
+        for k, v in {'stride': [int(x) for x in model.stride], 'names': labels}.items():  # for OnnxModel
+            meta = onnx_model.metadata_props.add()
+            meta.key, meta.value = k, str(v)
+        onnx.save(onnx_model, f)
         # print(onnx.helper.printable_graph(onnx_model.graph))  # print a human readable model
         print('ONNX export success, saved as %s' % f)
+
+        # Compare with PyTorch
+        ort = OnnxModel(f)
+        with torch.no_grad():
+            (d0, _), s0 = model(img)
+            (d1, _), s1 = ort(img)
+            print(f'ONNX Runtime max abs diff: detections {(d0 - d1).abs().max():.3g}, seg_logits {(s0 - s1).abs().max():.3g}')
+            for name, m in ('PyTorch', model), ('ONNX Runtime', ort):
+                m(img)  # warmup
+                t0 = time.time()
+                for _ in range(10):
+                    m(img)
+                print(f'{name}: {(time.time() - t0) * 100:.1f}ms per batch of {opt.batch_size}')
+        model.model[-1].onnx_dynamic = False
     except Exception as e:
         print('ONNX export failure: %s' % e)
 
+    # End-to-end export: letterbox, Detect() decoding, batched NMS and seg argmax in the graph
+    if opt.end2end:
+        try:
+            print('\nStarting end-to-end export with torch %s...' % torch.__version__)
+            s = max(opt.img_size)  # square letterbox size
+            model.model[-1].export = False
+            model.eval()
+            core = torch.jit.trace(MultitaskOutputs(model).eval(), torch.zeros(1, 3, s, s).to(device), check_trace=False)
+            e2e = torch.jit.script(End2End(core, s, opt.conf_thres, opt.iou_thres, opt.max_det, opt.agnostic_nms))
+            f = opt.weights.replace('.pt', '.end2end.torchscript.pt')  # filename
+            e2e.save(f)
+            print('End-to-end TorchScript export success, saved as %s' % f)
+
+            f = opt.weights.replace('.pt', '.end2end.onnx')  # filename
+            frames = torch.zeros(opt.batch_size, *opt.img_size, 3, dtype=torch.uint8).to(device)  # size(1,640,640,3)
+            kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+            torch.onnx.export(e2e, frames, f, opset_version=12, input_names=['frames'],
+                              output_names=['detections', 'counts', 'seg'],
+                              dynamic_axes={'frames': {0: 'batch', 1: 'height', 2: 'width'},  # size(1,640,640,3)
+                                            'detections': {0: 'batch'},  # size(1,max_det,6)
+                                            'counts': {0: 'batch'},  # size(1)
+                                            'seg': {0: 'batch', 1: 'height', 2: 'width'}}, **kwargs)  # size(1,640,640)
+            onnx_model = onnx.load(f)
+            meta = onnx_model.metadata_props.add()
+            meta.key, meta.value = 'names', str(labels)
+            onnx.save(onnx_model, f)
+            print('End-to-end ONNX export success, saved as %s' % f)
+
+            # Compare TorchScript and ONNX Runtime on a non-square frame batch
+            import onnxruntime
+            session = onnxruntime.InferenceSession(f, providers=['CPUExecutionProvider'])
+            frames = torch.randint(0, 256, (opt.batch_size, s // 2 + 7, s + 13, 3), dtype=torch.uint8)
+            with torch.no_grad():
+                y0 = e2e(frames.to(device))
+            y1 = session.run(None, {'frames': frames.numpy()})
+            print(f'ONNX Runtime vs TorchScript: detections max abs diff {(y0[0].cpu() - y1[0]).abs().max():.3g}, '
+                  f'counts equal {bool((y0[1].cpu().numpy() == y1[1]).all())}, '
+                  f'seg pixels differing {(y0[2].cpu().numpy() != y1[2]).mean():.2%}')
+        except Exception as e:
+            print('End-to-end export failure: %s' % e)
+
     # CoreML export
     try:
         import coremltools as ct
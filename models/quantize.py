@@ -0,0 +1,88 @@
+"""Post-training static INT8 quantization of a multitask *.pt model for CPU inference
+
+Every Conv2d (backbone, neck, Detect() and the seg head modules) is quantized to INT8 with observers calibrated on the
+detection and segmentation val images. The result is saved as *_int8.pt and loads with attempt_load(), i.e. in
+detect.py/test.py with --device cpu.
+
+Usage:
+    $ export PYTHONPATH="$PWD" && python models/quantize.py --weights ./weights/best.pt --img-size 640
+"""
+
+import argparse
+import sys
+import time
+from copy import deepcopy
+
+sys.path.append('./')  # to run '$ python *.py' files in subdirectories
+
+import torch
+import yaml
+
+import SegmentationDataset
+import test
+from models.experimental import attempt_load
+from utils.datasets import create_dataloader
+from utils.general import set_logging, check_img_size, check_dataset, colorstr
+from utils.torch_utils import quantize_conv2d
+
+
+def benchmark(model, img, n=10):
+    # Returns mean CPU forward time (ms) of model on img
+    with torch.no_grad():
+        model(img)  # warmup
+        t = time.time()
+        for _ in range(n):
+            model(img)
+    return (time.time() - t) / n * 1E3
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default='./yolov5s.pt', help='weights path')
+    parser.add_argument('--data', type=str, default='data/custom.yaml', help='data.yaml path, val + segval calibrate')
+    parser.add_argument('--img-size', type=int, default=640, help='calibration and evaluation size (pixels)')
+    parser.add_argument('--batch-size', type=int, default=4, help='batch size')
+    parser.add_argument('--calib-batches', type=int, default=32, help='maximum calibration batches per task')
+    parser.add_argument('--engine', default='x86', help='quantized engine: x86, fbgemm, qnnpack (ARM)')
+    parser.add_argument('--single-cls', action='store_true', help='treat as single-class dataset')
+    parser.add_argument('--n-segcls', type=int, default=9, help='number of segmentation classes')
+    opt = parser.parse_args()
+    print(opt)
+    set_logging()
+
+    # Load FP32 model and val data
+    device = torch.device('cpu')
+    model = attempt_load(opt.weights, map_location=device)  # load FP32 model
+    gs = max(int(model.stride.max()), 32)  # grid size (max stride)
+    imgsz = check_img_size(opt.img_size, s=gs)
+    with open(opt.data) as f:
+        data = yaml.load(f, Loader=yaml.SafeLoader)
+    check_dataset(data)
+    detloader = create_dataloader(data['val'], imgsz, opt.batch_size, gs, opt, pad=0.5, rect=True, workers=0,
+                                  prefix=colorstr('val: '))[0]
+    segloader = SegmentationDataset.get_custom_loader(root=data['segval'], batch_size=1, split='val', mode='testval',
+                                                      base_size=imgsz, workers=0, pin=False)
+
+    # Calibrate and convert
+    batches = [img.float() / 255.0 for i, (img, *_) in zip(range(opt.calib_batches), detloader)] + \
+              [img for i, (img, _) in zip(range(opt.calib_batches), segloader)]
+    qmodel = quantize_conv2d(deepcopy(model), batches, opt.engine)
+    print(f'Quantized {sum(isinstance(m, torch.ao.nn.quantized.Conv2d) for m in qmodel.modules())} Conv2d layers to INT8')
+    f = opt.weights.replace('.pt', '_int8.pt')  # filename
+    ckpt = {'model': deepcopy(model).half(), 'epoch': -1,  # fused FP32 structure, INT8 weights and ranges
+            'int8': {'engine': opt.engine, 'state_dict': qmodel.state_dict()}}
+    torch.save(ckpt, f)
+    print(f'INT8 model saved as {f}')
+
+    # Accuracy and latency, FP32 vs INT8
+    results = []
+    for m in model, qmodel:
+        (mp, mr, map50, map, *_), _, _ = test.test(data, batch_size=opt.batch_size, imgsz=imgsz, model=m,
+                                                    single_cls=opt.single_cls, dataloader=detloader, plots=False)
+        miou = test.seg_validation(m, opt.n_segcls, segloader, device, half_precision=False)
+        results.append((map50, map, float(miou), benchmark(m, torch.zeros(1, 3, imgsz, imgsz))))
+    print(('\n' + '%12s' * 5) % ('', 'mAP@.5', 'mAP@.5:.95', 'mIoU', 'ms/img'))
+    for name, r in zip(('FP32', 'INT8'), results):
+        print(('%12s' + '%12.4g' * 4) % (name, *r))
+    (a50, a, ai, at), (b50, b, bi, bt) = results
+    print(('%12s' + '%+12.4g' * 3 + '%11.2fx') % ('delta', b50 - a50, b - a, bi - ai, at / bt))
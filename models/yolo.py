@@ -3,9 +3,11 @@
 import argparse
 import logging
 import sys
+from contextlib import nullcontext
 from copy import deepcopy
 
 import onnx.external_data_helper
+from torch.utils.checkpoint import checkpoint
 
 sys.path.append('./')  # to run '$ python *.py' files in subdirectories
 logger = logging.getLogger(__name__)
@@ -15,7 +17,7 @@ from models.experimental import *
 from utils.autoanchor import check_anchor_order
 from utils.general import make_divisible, check_file, set_logging
 from utils.torch_utils import time_synchronized, fuse_conv_and_bn, model_info, scale_img, initialize_weights, \
-    select_device, copy_attr
+    select_device, copy_attr, frozen_bn_stats
 
 try:
     import thop  # for FLOPS computation
@@ -178,6 +180,9 @@ class SegMaskPSP(nn.Module):
 class Detect(nn.Module):  
     stride = None  # strides computed during build
     export = False  # onnx export
+    onnx_dynamic = False  # rebuild grids from the input shape on every call, for dynamic-shape ONNX export
+    prefilter = None  # (conf_thres, topk): inference output only the top-k objectness > conf_thres candidates per image
+    max_tables = 16  # decode() tables cached per level shapes, e.g. rect validation batch shapes
 
     def __init__(self, nc=80, anchors=(), ch=()):  # detection layer
         super(Detect, self).__init__()
@@ -194,7 +199,6 @@ class Detect(nn.Module):
     
     def forward(self, x):
         # x = x.copy()  # for profiling
-        z = []  # inference output
         self.training |= self.export
         for i in range(self.nl):  
             x[i] = self.m[i](x[i])  # conv
@@ -202,16 +206,60 @@ class Detect(nn.Module):
             
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
-            if not self.training:  # inference
-                if self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
-
-                y = x[i].sigmoid()  
-                y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy 
-                y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh 
-                z.append(y.view(bs, -1, self.no))                           
-        
-        return x if self.training else (torch.cat(z, 1), x)  
+        return x if self.training else (self.decode(x), x)
+
+    def decode(self, x):
+        # Decodes all levels at once to (bs,n,no) xywh, obj, cls in input pixels. With self.prefilter = (conf_thres, k)
+        # only the k highest objectness anchors per image are decoded, n = k, rows with obj <= conf_thres zeroed;
+        # k = 0 for the largest number of candidates above conf_thres in the batch
+        bs = x[0].shape[0]
+        p = torch.cat([xi.view(bs, -1, self.no) for xi in x], 1)  # (bs,n,no) logits
+        grid, stride, anchor = self.tables(x)  # (n,2), (n,1), (n,2)
+        if self.prefilter is not None:
+            conf_thres, k = self.prefilter
+            # objectness logit threshold, sigmoid(t) = conf_thres, clamped for conf_thres 0 and 1
+            t = -math.inf if conf_thres <= 0 else math.log(conf_thres / max(1 - conf_thres, 1E-12))
+            obj = p[..., 4]
+            k = min(k or max(int((obj > t).sum(1).max()), 1), p.shape[1])
+            j = obj.topk(k, 1)[1].sort(1)[0]  # (bs,k) best candidates, in anchor order (NMS ties as without prefilter)
+            obj = obj.gather(1, j)
+            p = p.gather(1, j[..., None].expand(-1, -1, self.no))
+            grid, stride, anchor = grid[j], stride[j], anchor[j]
+        y = p.sigmoid()
+        xy = (y[..., 0:2] * 2. - 0.5 + grid) * stride  # xy
+        wh = (y[..., 2:4] * 2) ** 2 * anchor  # wh
+        conf = y[..., 4:] if self.prefilter is None else y[..., 4:] * (obj > t)[..., None]  # zero rejected candidates
+        return torch.cat((xy, wh, conf), -1)
+
+    def tables(self, x):
+        # Returns grid offsets (n,2), strides (n,1) and anchor sizes (n,2) for the levels x, one row per anchor, cached
+        # by level shapes, device and dtype for the current anchor_grid version, the last max_tables shapes (LRU).
+        # Rebuilt on every call for dynamic-shape ONNX export
+        key = tuple(tuple(xi.shape[2:4]) for xi in x), x[0].device, x[0].dtype
+        version, cache = self.__dict__.get('_table_cache', (None, None))
+        if version != self.anchor_grid._version:  # anchors changed in place (autoanchor, ModelEMA.update())
+            version, cache = self.anchor_grid._version, {}
+            self.__dict__['_table_cache'] = version, cache
+        if key not in cache or self.onnx_dynamic:
+            grid, stride, anchor = [], [], []
+            for i, xi in enumerate(x):
+                _, _, ny, nx, _ = xi.shape
+                n = self.na * ny * nx
+                grid.append(self._make_grid(nx, ny).to(xi).expand(1, self.na, ny, nx, 2).reshape(n, 2))
+                stride.append(self.stride[i].to(xi).expand(n, 1))
+                anchor.append(self.anchor_grid[i].to(xi).expand(1, self.na, ny, nx, 2).reshape(n, 2))
+            if len(cache) >= self.max_tables:
+                del cache[next(iter(cache))]  # least recently used
+            cache[key] = torch.cat(grid), torch.cat(stride), torch.cat(anchor)
+        cache[key] = cache.pop(key)  # most recently used
+        return cache[key]
+
+    def __getstate__(self):
+        # Excludes the cached tables from pickling (checkpoints) and deepcopy
+        state = self.__dict__.copy()  # nn.Module.__getstate__() needs torch>=2.0
+        for k in '_table_cache', '_tables', '_compiled_call_impl':  # '_tables': unbounded cache of earlier checkpoints
+            state.pop(k, None)
+        return state
 
     @staticmethod
     def _make_grid(nx=20, ny=20):  
@@ -240,6 +288,8 @@ class Model(nn.Module):
             self.yaml['anchors'] = round(anchors)  # override yaml value
         self.model, self.save = parse_model(deepcopy(self.yaml), ch=[ch])  # model, savelist
         self.save.append(24)  
+        self.last_use()  # liveness table, frees saved outputs in forward_once()
+        self.grad_checkpoint(self.yaml.get('checkpoint'))  # yaml 'checkpoint: true' or a policy list, see --grad-ckpt
         self.names = [str(i) for i in range(self.yaml['nc'])]  # default names
         # print([x.shape for x in self.forward(torch.zeros(1, ch, 64, 64))])
 
@@ -259,30 +309,54 @@ class Model(nn.Module):
         self.info()
         logger.info('')
 
-    def forward(self, x, augment=False, profile=False):
+    tta = ((1, None), (0.83, 3), (0.67, None))  # default test-time augmentation (scale, flip), flips 2-ud, 3-lr
+
+    def forward(self, x, augment=False, profile=False, tasks=None):
+        # tasks: subset of {'det', 'seg'} to compute, the other head's output is None. Defaults to self.tasks or all
+        # augment: True for self.tta or a sequence of (scale, flip) transforms, e.g. ((1, None), (1, 3))
         if augment:
-            img_size = x.shape[-2:]  # height, width
-            s = [1, 0.83, 0.67]  # scales
-            f = [None, 3, None]  # flips (2-ud, 3-lr)
-            y = []  # outputs
-            for si, fi in zip(s, f):
-                xi = scale_img(x.flip(fi) if fi else x, si, gs=int(self.stride.max()))
-                yi = self.forward_once(xi)[0]  # forward
-                # cv2.imwrite(f'img_{si}.jpg', 255 * xi[0].cpu().numpy().transpose((1, 2, 0))[:, :, ::-1])  # save
-                yi[..., :4] /= si  # de-scale
-                if fi == 2:
-                    yi[..., 1] = img_size[0] - yi[..., 1]  # de-flip ud
-                elif fi == 3:
-                    yi[..., 0] = img_size[1] - yi[..., 0]  # de-flip lr
-                y.append(yi)
-            return torch.cat(y, 1), None  # augmented inference, train
+            return self.forward_augment(x, self.tta if augment is True else augment, tasks)  # augmented inference
         else:
-            return self.forward_once(x, profile)  # single-scale inference, train
-
-    def forward_once(self, x, profile=False):
+            return self.forward_once(x, profile, tasks)  # single-scale inference, train
+
+    def forward_augment(self, x, transforms, tasks=None):
+        # Test-time augmentation of both heads. Transforms of the same scale run as one batch, detections of all
+        # transforms are concatenated for NMS and seg logits are un-flipped, resized and averaged
+        bs, img_size = x.shape[0], x.shape[-2:]  # height, width
+        gs = int(self.stride.max())
+        y, seg = [], 0.  # outputs
+        for si in dict.fromkeys(s for s, _ in transforms):  # scales, in order
+            f = [fi for s, fi in transforms if s == si]  # flips at this scale (2-ud, 3-lr)
+            xi = scale_img(torch.cat([x.flip(fi) if fi else x for fi in f], 0), si, gs=gs)
+            det, segi = self.forward_once(xi, tasks=tasks)  # forward
+            for k, fi in enumerate(f):
+                if det is not None:
+                    yi = det[0][k * bs:(k + 1) * bs]
+                    yi[..., :4] /= si  # de-scale
+                    if fi == 2:
+                        yi[..., 1] = img_size[0] - yi[..., 1]  # de-flip ud
+                    elif fi == 3:
+                        yi[..., 0] = img_size[1] - yi[..., 0]  # de-flip lr
+                    y.append(yi)
+                if segi is not None:
+                    r = segi.shape[-1] / xi.shape[-1]  # seg output / input size
+                    sk = segi[k * bs:(k + 1) * bs, :, :int(int(img_size[0] * si) * r), :int(int(img_size[1] * si) * r)]
+                    sk = sk.flip(fi) if fi else sk  # crop padding, de-flip
+                    size = [round(d * r) for d in img_size]
+                    seg = seg + (sk if list(sk.shape[-2:]) == size else
+                                 F.interpolate(sk, size=size, mode='bilinear', align_corners=False))  # de-scale
+        return [(torch.cat(y, 1), None) if y else None, seg / len(transforms) if torch.is_tensor(seg) else None]
+
+    def forward_once(self, x, profile=False, tasks=None):
         y, dt = [], []  # outputs 
         out = []  
+        keep = self.task_layers(tasks or getattr(self, 'tasks', None))
+        free = self.last_use(tasks or getattr(self, 'tasks', None))
+        ckpt = getattr(self, 'ckpt', ())  # activation checkpointed layers, models saved before grad_checkpoint() have none
         for m in self.model:
+            if keep is not None and m.i not in keep:  # not needed by the requested heads
+                y.append(None)
+                continue
             if m.f != -1:  # if not from previous layer 
                 x = y[m.f] if isinstance(m.f, int) else [x if j == -1 else y[j] for j in m.f]  # from earlier layers
                     
@@ -295,14 +369,96 @@ class Model(nn.Module):
                 dt.append((time_synchronized() - t) * 100)
                 print('%10.1f%10.0f%10.1fms %-40s' % (o, m.np, dt[-1], m.type))
             
-            x = m(x)  # run
+            if m.i in ckpt and self.training and torch.is_grad_enabled():
+                x = checkpoint(m, x, use_reentrant=False,  # run, activations recomputed in backward
+                               context_fn=lambda: (nullcontext(), frozen_bn_stats(m)))  # BN stats updated once
+            else:
+                x = m(x)  # run
             # print(m.i, m.type, x.shape if m.f !=-1 else [a.shape for a in x])
             y.append(x if m.i in self.save else None)  # save output
+            for j in free.get(m.i, ()):  # saved outputs m was the last consumer of
+                y[j] = None
 
         if profile:
             print('%.1fms total' % sum(dt))
 
-        return [x, y[-2]]  
+        heads = self.heads()
+        return [x if keep is None or heads['det'] in keep else None, y[heads['seg']]]
+
+    def heads(self):
+        # Returns {'det': Detect() index, 'seg': segmentation head index}
+        seg = [m.i for m in self.model if m.type.split('.')[-1].startswith('SegMask')]
+        return {'det': len(self.model) - 1, 'seg': seg[0] if seg else 24}
+
+    def grad_checkpoint(self, policy=None):
+        # Sets the layers that recompute their activations in backward instead of keeping them (training memory for
+        # compute). policy: True, or a list of layer indices and/or 'blocks' (C3/BottleneckCSP), 'neck' (layers after
+        # the backbone), 'seg' (segmentation head), 'all' (all three). Detect() is never checkpointed
+        if policy is True:
+            policy = ['all']
+        heads = self.heads()
+        groups = {'blocks': {m.i for m in self.model if m.type.split('.')[-1] in ('C3', 'BottleneckCSP')},
+                  'neck': set(range(len(self.yaml['backbone']), heads['det'])) - {heads['seg']},
+                  'seg': {heads['seg']}}
+        groups['all'] = set().union(*groups.values())
+        self.ckpt = set()
+        for p in policy or ():
+            self.ckpt |= groups[p] if p in groups else {int(p)}
+        self.ckpt.discard(heads['det'])
+        return self
+
+    def task_layers(self, tasks=None):
+        # Returns the set of layer indices needed to compute the heads of tasks ({'det'}, {'seg'}), None for all layers
+        if not tasks or set(tasks) >= {'det', 'seg'}:
+            return None
+        cache = self.__dict__.setdefault('_task_layers', {})
+        key = frozenset(tasks)
+        if key not in cache:
+            heads = self.heads()
+            keep, todo = set(), [heads[t] for t in tasks]
+            while todo:
+                i = todo.pop()
+                if i in keep:
+                    continue
+                keep.add(i)
+                f = self.model[i].f
+                todo.extend(i - 1 if j == -1 else j for j in ([f] if isinstance(f, int) else f) if i > 0)
+            cache[key] = keep
+        return cache[key]
+
+    def last_use(self, tasks=None):
+        # Returns {layer index: saved layer indices it is the last consumer of} over the layers tasks run, so their
+        # outputs can be released as soon as that layer has run. Head outputs are kept
+        cache = self.__dict__.setdefault('_last_use', {})
+        key = frozenset(tasks) if tasks else None
+        if key not in cache:
+            keep = self.task_layers(tasks)
+            last = {}  # saved layer index: last consumer index
+            for m in self.model:
+                if keep is None or m.i in keep:
+                    for j in [m.f] if isinstance(m.f, int) else m.f:
+                        if j != -1:
+                            last[j % len(self.model)] = m.i
+            heads = set(self.heads().values())
+            cache[key] = {}
+            for j, i in last.items():
+                if j not in heads:
+                    cache[key].setdefault(i, []).append(j)
+        return cache[key]
+
+    def select_tasks(self, tasks):
+        # Replace the layers that tasks do not need by empty placeholders, for a slimmed single-task model
+        keep = self.task_layers(tasks)
+        if keep is not None:
+            print(f"Keeping {', '.join(sorted(tasks))} head(s), pruning {len(self.model) - len(keep)} layers... ")
+            for i, m in enumerate(self.model):
+                if m.i not in keep:
+                    p = nn.Identity()
+                    p.i, p.f, p.type, p.np = m.i, m.f, 'pruned', 0  # attach index, 'from' index, type, number params
+                    self.model[i] = p
+            self.tasks = set(tasks)
+            self.info()
+        return self
 
     def _initialize_biases(self, cf=None):  # initialize biases into Detect(), cf is class frequency
         # https://arxiv.org/abs/1708.02002 section 3.3
@@ -332,9 +488,39 @@ class Model(nn.Module):
                 m.conv = fuse_conv_and_bn(m.conv, m.bn)  # update conv
                 delattr(m, 'bn')  # remove batchnorm
                 m.forward = m.fuseforward  # update forward
+            elif isinstance(m, nn.Sequential):  # bare nn.Conv2d, nn.BatchNorm2d pairs, i.e. ASPP/RFB2 branches
+                for i in range(len(m) - 1):
+                    if type(m[i]) is nn.Conv2d and type(m[i + 1]) is nn.BatchNorm2d:
+                        m[i] = fuse_conv_and_bn(m[i], m[i + 1])
+                        m[i + 1] = nn.Identity()
         self.info()
         return self
 
+    def reparam(self):  # merge parallel ASPP/RFB branches and fold global branches, after fuse(), for deployment
+        print('Re-parameterizing branches... ')
+        for m in self.model.modules():
+            if type(m) in (ASPP, ASPPs, RFB1, RFB2, FFM):
+                m.reparam()
+        self.info()
+        return self
+
+    def head_latency(self, x, n=10):
+        # Returns mean forward time (ms) of the layers only the det head needs, only the seg head needs and both share
+        det, seg = self.task_layers({'det'}) or set(), self.task_layers({'seg'}) or set()
+        group = {m.i: 'det' if m.i not in seg else 'seg' if m.i not in det else 'shared' for m in self.model}
+        dt = dict.fromkeys(('shared', 'det', 'seg'), 0.)
+        pre = lambda m, x: setattr(m, '_t', time_synchronized())
+        post = lambda m, x, y: dt.__setitem__(group[m.i], dt[group[m.i]] + time_synchronized() - m._t)
+        hooks = [h for m in self.model for h in (m.register_forward_pre_hook(pre), m.register_forward_hook(post))]
+        with torch.no_grad():
+            self.forward_once(x)  # warmup
+            dt.update(dict.fromkeys(dt, 0.))
+            for _ in range(n):
+                self.forward_once(x)
+        for h in hooks:
+            h.remove()
+        return {k: v / n * 1E3 for k, v in dt.items()}
+
     def nms(self, mode=True):  # add or remove NMS module
         present = type(self.model[-1]) is NMS  # last layer is NMS
         if mode and not present:
@@ -375,8 +561,8 @@ def parse_model(d, ch):  # model_dict, input_channels(3)
                 pass
         
         n = max(round(n * gd), 1) if n > 1 else n  # depth gain
-        if m in [Conv, GhostConv, Bottleneck, GhostBottleneck, SPP, DWConv, MixConv2d, Focus, CrossConv, BottleneckCSP,
-                 C3, C3TR, ASPP]:
+        if m in [Conv, GhostConv, Bottleneck, GhostBottleneck, SPP, SPPF, DWConv, MixConv2d, Focus, CrossConv,
+                 BottleneckCSP, C3, C3TR, ASPP]:
             c1, c2 = ch[f], args[0]  
             if c2 != no:  # if not output
                 c2 = make_divisible(c2 * gw, 8)  
@@ -422,6 +608,11 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--cfg', type=str, default='yolov5s_custom_seg.yaml', help='model.yaml')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--fuse', action='store_true', help='check fused vs unfused outputs and per-head latency')
+    parser.add_argument('--weights', type=str, default='', help='--fuse weights path, random init if empty')
+    parser.add_argument('--img-size', type=int, default=640, help='--fuse/--grad-ckpt image size (pixels)')
+    parser.add_argument('--grad-ckpt', nargs='+', help='report activation checkpointing memory and time for a policy')
+    parser.add_argument('--batch-size', type=int, default=2, help='--grad-ckpt batch size')
     opt = parser.parse_args()
     opt.cfg = check_file(opt.cfg)  # check file
     set_logging()
@@ -430,6 +621,59 @@ if __name__ == '__main__':
     # Create model
     model = Model(opt.cfg).to(device)
     model.train()
+
+    # Fusion check
+    if opt.fuse:
+        if opt.weights:
+            ckpt = torch.load(opt.weights, map_location=device)  # load
+            model = ckpt['ema' if ckpt.get('ema') else 'model'].float()
+        else:  # random BatchNorm2d statistics and affine, so fusion is not the identity
+            for m in model.modules():
+                if isinstance(m, nn.BatchNorm2d):
+                    m.running_mean.uniform_(-0.5, 0.5), m.running_var.uniform_(0.5, 2.0)
+                    m.weight.data.uniform_(0.5, 1.5), m.bias.data.uniform_(-0.5, 0.5)
+        model.eval()
+        fused = deepcopy(model).fuse().eval()
+        merged = deepcopy(fused).reparam().eval()
+        img = torch.rand(1, 3, opt.img_size, opt.img_size).to(device)
+        with torch.no_grad():
+            (d0, _), s0 = model(img)
+            (d1, _), s1 = fused(img)
+            (d2, _), s2 = merged(img)
+        n = sum(isinstance(m, nn.BatchNorm2d) for m in fused.modules())
+        print(f'\nBatchNorm2d left after fuse(): {n}\nmax abs diff: detections {(d0 - d1).abs().max():.3g}, '
+              f'seg logits {(s0 - s1).abs().max():.3g}; after reparam(): seg logits {(s0 - s2).abs().max():.3g}')
+        t = [m.head_latency(img) for m in (model, fused, merged)]
+        print(('%12s' * 5) % ('', 'unfused ms', 'fused ms', 'reparam ms', 'saved'))
+        for k in t[0]:
+            print(('%12s' + '%12.1f' * 3 + '%11.1f%%') % (k, *(x[k] for x in t), 100 * (1 - t[2][k] / max(t[0][k], 1E-9))))
+
+    # Activation checkpointing: activation memory kept for backward (peak allocated on CUDA) and det + seg step time
+    if opt.grad_ckpt:
+        img = torch.rand(opt.batch_size, 3, opt.img_size, opt.img_size).to(device)
+        results = []
+        for policy in None, opt.grad_ckpt:
+            model.grad_checkpoint(policy).train()
+            saved = {}  # tensors kept for backward, by storage
+            pack = lambda t: (saved.setdefault(t.untyped_storage().data_ptr(), t.untyped_storage().nbytes()), t)[1]
+            for k in range(3):  # warmup, timed
+                saved.clear()
+                if device.type != 'cpu':
+                    torch.cuda.reset_peak_memory_stats(device)
+                t = time_synchronized()
+                for tasks in {'det'}, {'seg'}:  # one train_custom.py step of each task
+                    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+                        y = model(img, tasks=tasks)
+                    (sum(x.float().mean() for x in y[0]) if y[0] is not None else y[1].float().mean()).backward()
+                t = time_synchronized() - t
+            mem = torch.cuda.max_memory_allocated(device) if device.type != 'cpu' else sum(saved.values())
+            results.append((mem / 1E6, t * 1E3))
+        print(f'\nActivation checkpointing {opt.grad_ckpt}: layers {sorted(model.ckpt)}')
+        print(('%12s' * 3) % ('', 'MB', 'ms/step'))
+        for name, r in zip(('none', 'checkpoint'), results):
+            print(('%12s' + '%12.1f' * 2) % (name, *r))
+        (m0, t0), (m1, t1) = results
+        print(f'saved {100 * (1 - m1 / m0):.1f}% memory for {100 * (t1 / t0 - 1):.1f}% extra compute')
   #  model.eval()
     pass
     # a = torch.randn((1, 3, 1024, 2048), device=device)
@@ -0,0 +1,161 @@
+"""Local dynamic-batching inference server
+
+Concurrent requests are collected into micro-batches (--max-batch images or --max-wait ms, whichever comes first)
+and run through one autoShape forward pass. Usage:
+    $ python serve.py --weights best.pt --port 8000  # or --unix /tmp/multitask.sock
+    $ curl --data-binary @image.jpg 'http://127.0.0.1:8000/predict?seg=rle'
+    $ curl http://127.0.0.1:8000/stats
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter, deque
+from urllib.parse import urlparse, parse_qs
+
+import cv2
+import numpy as np
+import torch
+
+from detect import Lenticwater_Class, mask2rle
+from models.experimental import attempt_load
+from utils.general import check_img_size, check_requirements, set_logging
+from utils.torch_utils import select_device
+
+
+class BatchServer:
+    # Collects requests into micro-batches for one model, keeps queue/batch/latency statistics
+    def __init__(self, model, size=640, max_batch=8, max_wait=0.005):
+        self.model = model
+        self.size = size
+        self.max_batch = max_batch
+        self.max_wait = max_wait  # seconds
+        self.queue = asyncio.Queue()
+        self.batches = Counter()  # batch size histogram
+        self.latency = deque(maxlen=10000)  # request latencies (seconds), most recent
+        self.max_depth = 0
+
+    async def predict(self, img):
+        # Queue one RGB HWC image, returns its Detections once its batch has run
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((img, future, time.time()))
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return await future
+
+    async def run(self):
+        # Batching loop: wait for a first request, then fill the batch until it is full or max_wait has passed
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            imgs, futures, t0 = zip(*batch)
+            try:  # forward pass in a worker thread so the event loop keeps accepting requests
+                results = await loop.run_in_executor(None, lambda: self.model(list(imgs), size=self.size).tolist())
+            except Exception as e:
+                for f in futures:
+                    f.set_exception(e)
+                continue
+            self.batches[len(batch)] += 1
+            t = time.time()
+            for f, r, ti in zip(futures, results, t0):
+                f.set_result(r)
+                self.latency.append(t - ti)
+
+    def stats(self):
+        lat = np.array(self.latency) * 1E3 if self.latency else np.zeros(1)
+        p50, p95, p99 = np.percentile(lat, [50, 95, 99]).round(2).tolist()
+        return {'queue_depth': self.queue.qsize(), 'max_queue_depth': self.max_depth,
+                'requests': len(self.latency), 'batches': sum(self.batches.values()),
+                'batch_size_histogram': dict(sorted(self.batches.items())),
+                'latency_ms': {'p50': p50, 'p95': p95, 'p99': p99}}
+
+
+def to_json(r, seg='coverage'):
+    # Detections for one image to a JSON-able dict, seg in {'none', 'coverage', 'rle'}
+    out = {'boxes': [[*(round(v, 2) for v in x[:5]), int(x[5]), r.names[int(x[5])]] for x in r.pred.tolist()]}
+    if seg != 'none' and r.seg is not None:
+        m = r.seg
+        area = torch.bincount(m.flatten().long(), minlength=len(Lenticwater_Class)).tolist()
+        out['coverage'] = {Lenticwater_Class[c]: round(a / m.numel(), 6) for c, a in enumerate(area) if a}
+        if seg == 'rle':
+            m = m.cpu().numpy()
+            out['rle'] = {Lenticwater_Class[c]: mask2rle(m == c) for c, a in enumerate(area) if a}
+    return out
+
+
+async def handle(server, reader, writer):
+    # Minimal HTTP/1.1: POST /predict (encoded image body, ?seg=none|coverage|rle) and GET /stats
+    try:
+        method, target, _ = (await reader.readline()).decode().split()
+        headers = {}
+        while (line := (await reader.readline()).decode().strip()):
+            k, _, v = line.partition(':')
+            headers[k.strip().lower()] = v.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        url = urlparse(target)
+        if method == 'GET' and url.path == '/stats':
+            code, out = 200, server.stats()
+        elif method == 'POST' and url.path == '/predict':
+            img = cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_COLOR)
+            if img is None:
+                code, out = 400, {'error': 'could not decode image'}
+            else:
+                r = await server.predict(img[:, :, ::-1])  # BGR to RGB
+                code, out = 200, to_json(r, parse_qs(url.query).get('seg', ['coverage'])[0])
+        else:
+            code, out = 404, {'error': f'{method} {url.path} not found'}
+    except Exception as e:
+        code, out = 500, {'error': str(e)}
+    data = json.dumps(out).encode()
+    writer.write(f'HTTP/1.1 {code} {"OK" if code == 200 else "Error"}\r\nContent-Type: application/json\r\n'
+                 f'Content-Length: {len(data)}\r\nConnection: close\r\n\r\n'.encode() + data)
+    await writer.drain()
+    writer.close()
+
+
+async def main(opt):
+    device = select_device(opt.device)
+    model = attempt_load(opt.weights, map_location=device)  # load FP32 model
+    imgsz = check_img_size(opt.img_size, s=int(model.stride.max()))  # check img_size
+    model = model.autoshape()  # for np inputs and NMS
+    model.conf, model.iou = opt.conf_thres, opt.iou_thres
+    server = BatchServer(model, imgsz, opt.max_batch, opt.max_wait / 1E3)
+
+    cb = lambda r, w: handle(server, r, w)
+    if opt.unix:
+        s = await asyncio.start_unix_server(cb, path=opt.unix)
+    else:
+        s = await asyncio.start_server(cb, opt.host, opt.port)
+    print(f"Serving on {opt.unix or f'http://{opt.host}:{opt.port}'} (max batch {opt.max_batch}, "
+          f"max wait {opt.max_wait}ms)")
+    async with s:
+        await asyncio.gather(s.serve_forever(), server.run())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default='yolov5s.pt', help='model.pt path')
+    parser.add_argument('--img-size', type=int, default=640, help='inference size (pixels)')
+    parser.add_argument('--conf-thres', type=float, default=0.25, help='object confidence threshold')
+    parser.add_argument('--iou-thres', type=float, default=0.45, help='IOU threshold for NMS')
+    parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--host', default='127.0.0.1', help='HTTP bind address')
+    parser.add_argument('--port', type=int, default=8000, help='HTTP port')
+    parser.add_argument('--unix', default='', help='serve on this Unix socket path instead of TCP')
+    parser.add_argument('--max-batch', type=int, default=8, help='maximum images per forward pass')
+    parser.add_argument('--max-wait', type=float, default=5., help='maximum time to wait for a batch to fill (ms)')
+    opt = parser.parse_args()
+    print(opt)
+    set_logging()
+    check_requirements(exclude=('pycocotools', 'thop'))
+    asyncio.run(main(opt))
@@ -9,10 +9,11 @@ import torch
 import yaml
 from tqdm import tqdm
 
-from models.experimental import attempt_load
+from models.experimental import attempt_load, BackendModel
 from utils.datasets import create_dataloader
 from utils.general import coco80_to_coco91_class, check_dataset, check_file, check_img_size, check_requirements, \
-    box_iou, non_max_suppression, scale_coords, xyxy2xywh, xywh2xyxy, set_logging, increment_path, colorstr
+    box_iou, non_max_suppression, batched_non_max_suppression, scale_coords, xyxy2xywh, xywh2xyxy, set_logging, \
+    increment_path, colorstr
 from utils.metrics import ap_per_class, ConfusionMatrix, batch_pix_accuracy, batch_intersection_union  # 后两个新增分割
 from utils.plots import plot_images, output_to_target, plot_study_txt
 from utils.torch_utils import select_device, time_synchronized
@@ -38,12 +39,16 @@ def seg_validation(model, n_segcls, valloader, device, half_precision=True):
         model.half()
     model.eval()
     total_inter, total_union, total_correct, total_label = 0, 0, 0, 0
+    seen, dt = 0, 0.  # images, inference time
     tbar = tqdm(valloader, desc='\r')
     for i, (image, target) in enumerate(tbar):
         image = image.to(device, non_blocking=True)
         image = image.half() if half else image.float()
         with torch.no_grad():
+            t = time_synchronized()
             correct, labeled, inter, union = eval_batch(model, image, target, half)
+            dt += time_synchronized() - t
+            seen += image.shape[0]
 
         total_correct += correct
         total_label += labeled
@@ -55,12 +60,15 @@ def seg_validation(model, n_segcls, valloader, device, half_precision=True):
         tbar.set_description(
             'pixAcc: %.3f, mIoU: %.3f' % (pixAcc, mIoU))
     # print(mIoU)
+    print(f'Seg validation speed: {dt / max(seen, 1) * 1E3:.1f} ms/img ({type(model).__name__})')
     return mIoU
 
 
 def segtest(weights, root="data/citys", batch_size=16, half_precision=True, n_segcls=19, base_size=2048):  #
     device = select_device(opt.device, batch_size=batch_size)
-    model = attempt_load(weights, map_location=device)  # load FP32 model
+    model = attempt_load(weights, map_location=device, threads=opt.ort_threads)  # load FP32 model (*.onnx: ORT)
+    if opt.backend != 'eager':
+        model = BackendModel(model, opt.backend)  # TorchScript / torch.compile, built per input shape
     testvalloader = SegmentationDataset.get_citys_loader(root, batch_size=batch_size, split="val", mode="testval", workers=4, base_size=base_size)
     # testvalloader = SegmentationDataset.get_citys_loader(root, batch_size=batch_size, split="val", mode="val", workers=4, base_size=1024, crop_size=1024)
     seg_validation(model, n_segcls, testvalloader, device, half_precision)
@@ -91,7 +99,7 @@ def test(data,
     # Initialize/load model and set device
     training = model is not None
     if training:  # called by train.py
-        device = next(model.parameters()).device  # get model device
+        device = next(model.parameters(), next(model.buffers(), torch.zeros(0))).device  # model device, INT8: buffers/CPU
 
     else:  # called directly
         set_logging()
@@ -102,7 +110,7 @@ def test(data,
         (save_dir / 'labels' if save_txt else save_dir).mkdir(parents=True, exist_ok=True)  # make dir
 
         # Load model
-        model = attempt_load(weights, map_location=device)  # load FP32 model
+        model = attempt_load(weights, map_location=device, threads=opt.ort_threads)  # load FP32 model (*.onnx: ORT)
         gs = max(int(model.stride.max()), 32)  # grid size (max stride)
         imgsz = check_img_size(imgsz, s=gs)  # check img_size
 
@@ -112,9 +120,12 @@ def test(data,
 
     # Half
     half = device.type != 'cpu' and half_precision  # half precision only supported on CUDA
+    half &= any(True for _ in model.parameters())  # ONNX Runtime runs FP32 on CPU
     # half = False
     if half:
         model.half()
+    if not training and opt.backend != 'eager':
+        model = BackendModel(model, opt.backend)  # TorchScript / torch.compile, built per input shape
 
     # Configure
     model.eval()
@@ -134,7 +145,7 @@ def test(data,
     # Dataloader
     if not training:
         if device.type != 'cpu':
-            model(torch.zeros(1, 3, imgsz, imgsz).to(device).type_as(next(model.parameters())))  # run once
+            model(torch.zeros(1, 3, imgsz, imgsz, device=device, dtype=torch.half if half else torch.float))  # run once
         task = opt.task if opt.task in ('train', 'val', 'test') else 'val'  # path to train/val/test images
         dataloader = create_dataloader(data[task], imgsz, batch_size, gs, opt, pad=0.5, rect=True,
                                        prefix=colorstr(f'{task}: '))[0]
@@ -168,7 +179,12 @@ def test(data,
             targets[:, 2:] *= torch.Tensor([width, height, width, height]).to(device)  # to pixels
             lb = [targets[targets[:, 0] == i, 1:] for i in range(nb)] if save_hybrid else []  # for autolabelling
             t = time_synchronized()
-            out = non_max_suppression(out, conf_thres=conf_thres, iou_thres=iou_thres, labels=lb, multi_label=True)
+            if device.type != 'cpu':  # one NMS call for the whole batch (on CPU per image, NMS cost grows with boxes^2)
+                out, n = batched_non_max_suppression(out, conf_thres=conf_thres, iou_thres=iou_thres, labels=lb,
+                                                     multi_label=True)
+                out = [o[:k] for o, k in zip(out, n.tolist())]
+            else:
+                out = non_max_suppression(out, conf_thres=conf_thres, iou_thres=iou_thres, labels=lb, multi_label=True)
             t1 += time_synchronized() - t
 
         # Statistics per image
@@ -352,6 +368,9 @@ if __name__ == '__main__':
     parser.add_argument('--save-hybrid', action='store_true', help='save label+prediction hybrid results to *.txt')
     parser.add_argument('--save-conf', action='store_true', help='save confidences in --save-txt labels')
     parser.add_argument('--save-json', action='store_true', help='save a cocoapi-compatible JSON results file')
+    parser.add_argument('--backend', default='eager', choices=['eager', 'jit', 'compile'],
+                        help='*.pt inference backend: eager, frozen TorchScript or torch.compile')
+    parser.add_argument('--ort-threads', nargs=2, type=int, default=[0, 0], help='*.onnx intra/inter-op threads, 0 auto')
     parser.add_argument('--project', default='runs/test', help='save to project/name')
     parser.add_argument('--name', default='exp', help='save to project/name')
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
@@ -4,7 +4,6 @@ import math
 import os
 import random
 import time
-from copy import deepcopy
 from pathlib import Path
 from threading import Thread
 
@@ -25,7 +24,8 @@ import test  # import test.py to get mAP after each epoch
 from models.experimental import attempt_load
 from models.yolo import Model
 from utils.autoanchor import check_anchors
-from utils.datasets import create_dataloader
+from utils.checkpoints import CheckpointWriter
+from utils.datasets import create_dataloader, TaskScheduler
 from utils.general import labels_to_class_weights, increment_path, labels_to_image_weights, init_seeds, \
     fitness, fitness2, strip_optimizer, get_latest_run, check_dataset, check_file, check_git_status, check_img_size, \
     check_requirements, print_mutation, set_logging, one_cycle, colorstr
@@ -96,6 +96,10 @@ def train(hyp, opt, device, tb_writer=None):
         logger.info('Transferred %g/%g items from %s' % (len(state_dict), len(model.state_dict()), weights))  # report
     else:  
         model = Model(opt.cfg, ch=3, nc=nc, anchors=hyp.get('anchors')).to(device)  # create
+    if opt.grad_ckpt:
+        model.grad_checkpoint(opt.grad_ckpt)
+    if model.ckpt:
+        logger.info(f'Activation checkpointing layers {sorted(model.ckpt)}')
     with torch_distributed_zero_first(rank):
         check_dataset(data_dict)  # check
     train_path = data_dict['train']
@@ -147,6 +151,10 @@ def train(hyp, opt, device, tb_writer=None):
     scheduler = lr_scheduler.LambdaLR(optimizer, lr_lambda=lf)  
     # plot_lr_scheduler(optimizer, scheduler, epochs)
 
+    # Channels-last (NHWC) weights and inputs, before EMA so that it matches
+    mf = torch.channels_last if opt.channels_last else torch.contiguous_format  # memory format
+    model.to(memory_format=mf)
+
     # EMA
     ema = ModelEMA(model) if rank in [-1, 0] else None
 
@@ -190,7 +198,10 @@ def train(hyp, opt, device, tb_writer=None):
     # SyncBatchNorm
     if opt.sync_bn and cuda and rank != -1:
         model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model).to(device)
-        logger.info('Using SyncBatchNorm()')
+        bn = [(m.i, type(x)) for m in model.model for x in m.modules() if isinstance(x, nn.modules.batchnorm._BatchNorm)]
+        assert all(t is nn.SyncBatchNorm for _, t in bn), 'BatchNorm layers not converted to SyncBatchNorm'
+        nseg = sum(i == model.heads()['seg'] for i, _ in bn)  # seg head BN layers
+        logger.info(f'Using SyncBatchNorm() ({len(bn)} layers, {nseg} in the seg head)')
 
     # Trainloader
     dataloader, dataset = create_dataloader(train_path, imgsz, batch_size, gs, opt,
@@ -198,7 +209,6 @@ def train(hyp, opt, device, tb_writer=None):
                                             world_size=opt.world_size, workers=opt.workers,
                                             image_weights=opt.image_weights, quad=opt.quad, prefix=colorstr('train: '))
     mlc = np.concatenate(dataset.labels, 0)[:, 0].max()  # max label class
-    nb = len(dataloader)  # number of batches
     
     assert mlc < nc, 'Label class %g exceeds nc=%g in %s. Possible class labels are 0-%g' % (mlc, nc, opt.data, nc - 1)
 
@@ -241,19 +251,27 @@ def train(hyp, opt, device, tb_writer=None):
     #                                                                  
     
     
+    seg_batch_size = (opt.seg_batch_size or total_batch_size) // opt.world_size
     seg_trainloader = SegmentationDataset.get_custom_loader(root=segtrain_path,
                                                            split="train", mode="train",
-                                                           base_size=imgsz,
+                                                           base_size=opt.seg_img_size or imgsz,
                                                            
-                                                           batch_size=batch_size,
-                                                           workers=opt.workers, pin=True)
-
-    segnb = len(seg_trainloader)
+                                                           batch_size=seg_batch_size,
+                                                           workers=min(os.cpu_count() // opt.world_size, opt.workers),
+                                                           pin=True, rank=rank)  # DDP: sharded over ranks
+
+    # Task scheduler, det and seg batches in --task-ratio proportion, epochs of --epoch-samples images
+    task_scheduler = TaskScheduler({'det': dataloader, 'seg': seg_trainloader},
+                                   dict(zip(('det', 'seg'), opt.task_ratio)) if opt.task_ratio else None,
+                                   opt.epoch_samples // opt.world_size, joint=opt.joint)
+    nsteps = len(task_scheduler)  # number of steps per epoch
     # DDP mode
     if cuda and rank != -1:  
         model = DDP(model, device_ids=[opt.local_rank], output_device=opt.local_rank,
                     # nn.MultiheadAttention incompatibility with DDP https://github.com/pytorch/pytorch/issues/26698
-                    find_unused_parameters=any(isinstance(layer, nn.MultiheadAttention) for layer in model.modules()))
+                    # det/seg steps only run their own head (unless --joint)
+                    find_unused_parameters=not opt.joint or
+                                           any(isinstance(layer, nn.MultiheadAttention) for layer in model.modules()))
 
     # Model parameters
     hyp['box'] *= 3. / nl  # scale to layers
@@ -268,13 +286,14 @@ def train(hyp, opt, device, tb_writer=None):
 
     # Start training
     t0 = time.time()
-    nw = max(round(hyp['warmup_epochs'] * nb), 500)  # number of warmup iterations, max(3 epochs, 1k iterations)
-    # nw = min(nw, (epochs - start_epoch) / 2 * nb)  # limit warmup to < 1/2 of training
+    nw = max(round(hyp['warmup_epochs'] * nsteps), 500)  # number of warmup iterations, max(3 epochs, 1k iterations)
+    # nw = min(nw, (epochs - start_epoch) / 2 * nsteps)  # limit warmup to < 1/2 of training
     maps = np.zeros(nc)  # mAP per class
     results = (0, 0, 0, 0, 0, 0, 0)  # P, R, mAP@.5, mAP@.5-.95, val_loss(box, obj, cls)
     scheduler.last_epoch = start_epoch - 1  # do not move
     scaler = amp.GradScaler(enabled=cuda)  
     compute_loss = ComputeLoss(model)  # init loss class
+    ckpt_writer = CheckpointWriter(wdir, keep=opt.keep_ckpts) if rank in [-1, 0] else None  # background saves
   
 # -----------------------------------------------------------------------------------------------------------
     # Base，PSP, Lab
@@ -292,6 +311,14 @@ def train(hyp, opt, device, tb_writer=None):
 
     detgain, seggain = 0.6, 0.35 
 
+    # torch.compile (opt-in) of the training forward and both losses, dynamic shapes for --multi-scale
+    fmodel, det_loss, seg_loss = model, compute_loss, compute_seg_loss
+    if opt.compile:
+        dynamic = True if opt.multi_scale else None  # None: recompile as dynamic once a new shape shows up
+        fmodel = torch.compile(model, dynamic=dynamic)
+        det_loss = torch.compile(compute_loss.__call__, dynamic=dynamic)
+        seg_loss = torch.compile(compute_seg_loss, dynamic=dynamic)
+
 
 
     logger.info(f'Image sizes {imgsz} train, {imgsz_test} test\n'
@@ -323,31 +350,27 @@ def train(hyp, opt, device, tb_writer=None):
 
         mloss = torch.zeros(4, device=device)  # mean losses
         msegloss = torch.zeros(1, device=device)  # mean losses
-        if rank != -1:
-            dataloader.sampler.set_epoch(epoch)  
-        pbar = enumerate(dataloader)
-        segpbar = enumerate(seg_trainloader)
+        pbar = enumerate(task_scheduler)  # DDP samplers move to a new epoch on every pass over their dataset
         logger.info(('\n' + '%10s' * 9) % ('Epoch', 'gpu_mem', 'box', 'obj', 'cls', 'total', 'seg', 'labels', 'img_size'))
         if rank in [-1, 0]:
-            pbar = tqdm(pbar, total=min(nb, segnb))  # progress bar 
-            segpbar = tqdm(segpbar, total=min(nb, segnb))
+            pbar = tqdm(pbar, total=nsteps)  # progress bar 
         optimizer.zero_grad()  
 
         
-        for det_batch, seg_batch in zip(pbar, segpbar):  # batch -------------------------------------------------------------
-            i, (imgs, targets, paths, _) = det_batch  
-            _, (segimgs, segtargets) = seg_batch  
-
-            ignore_classes = [0]
-            ignore_tensor = torch.tensor(ignore_classes)
-            mask2 = torch.isin(segtargets, ignore_tensor)
-            segtargets[mask2] = -1
-
-            if len(imgs)==1 or len(segimgs)==1:  
-                continue
+        t_epoch = time.time()
+        for i, batch in pbar:  # batch -------------------------------------------------------------
+            det, seg = 'det' in batch, 'seg' in batch  # tasks of this step
+            if det:
+                imgs, targets, paths, _ = batch['det']
+                imgs = imgs.to(device, non_blocking=True, memory_format=mf).float() / 255.0  # uint8 to float32, 0-1
+            if seg:
+                segimgs, segtargets = batch['seg']
+                ignore_classes = [0]
+                ignore_tensor = torch.tensor(ignore_classes)
+                mask2 = torch.isin(segtargets, ignore_tensor)
+                segtargets[mask2] = -1
             
-            ni = i + nb * epoch  # number integrated batches (since train start)
-            imgs = imgs.to(device, non_blocking=True).float() / 255.0  # uint8 to float32, 0-255 to 0.0-1.0
+            ni = i + nsteps * epoch  # number integrated batches (since train start)
             # Warmup
             if ni <= nw:
                 xi = [0, nw]  # x interp
@@ -359,7 +382,7 @@ def train(hyp, opt, device, tb_writer=None):
                     if 'momentum' in x:
                         x['momentum'] = np.interp(ni, xi, [hyp['warmup_momentum'], hyp['momentum']])
             # Multi-scale
-            if opt.multi_scale:
+            if opt.multi_scale and det:
                 sz = random.randrange(imgsz * 0.5, imgsz * 1.5 + gs) // gs * gs  # size
                 sf = sz / max(imgs.shape[2:])  # scale factor
                 if sf != 1:
@@ -368,36 +391,61 @@ def train(hyp, opt, device, tb_writer=None):
 
             # Forward and Backward
 
-            with amp.autocast(enabled=cuda):  
-                pred = model(imgs)  # forward
-                loss, loss_items = compute_loss(pred[0], targets.to(device))  # loss scaled by batch_size
-                if rank != -1:  
-                    loss *= opt.world_size  # gradient averaged between devices in DDP mode
-                if opt.quad:
-                    loss *= 4.
-                loss *= detgain  
-            scaler.scale(loss).backward()
-            imgshape = imgs.shape[-1]
-            if plots and ni >= 3:
-                del imgs  
+            if det and seg:  # --joint, one forward pass for det + seg batches, det/seg loss on det/seg samples only
+                nd = len(imgs)  # det samples
+                segimgs = segimgs.to(device, non_blocking=True, memory_format=mf)
+                if segimgs.shape[2:] != imgs.shape[2:]:  # common resolution (multi-scale, rect)
+                    segimgs = F.interpolate(segimgs, size=imgs.shape[2:], mode='bilinear', align_corners=False)
+                    segtargets = F.interpolate(segtargets[:, None].float(), size=imgs.shape[2:], mode='nearest')[:, 0]
+                    segtargets = segtargets.long()
+                with amp.autocast(enabled=cuda):
+                    pred = fmodel(torch.cat((imgs, segimgs.type_as(imgs)), 0))  # forward
+                    loss, loss_items = det_loss([x[:nd] for x in pred[0]], targets.to(device))  # by batch_size
+                    if rank != -1:
+                        loss *= opt.world_size  # gradient averaged between devices in DDP mode
+                    if opt.quad:
+                        loss *= 4.
+                    loss *= detgain
+                    segloss = seg_loss(pred[1][nd:], segtargets.to(device)) * seg_batch_size * seggain
+                scaler.scale(loss + segloss).backward()
+                imgshape = imgs.shape[-1]
+                if plots and ni >= 3:
+                    del imgs
+                else:
+                    imgs = imgs.to(torch.device('cpu'), non_blocking=True)
+                del segimgs
+            elif det:
+                with amp.autocast(enabled=cuda):  
+                    pred = fmodel(imgs, tasks={'det'})  # forward, det head only
+                    loss, loss_items = det_loss(pred[0], targets.to(device))  # loss scaled by batch_size
+                    if rank != -1:  
+                        loss *= opt.world_size  # gradient averaged between devices in DDP mode
+                    if opt.quad:
+                        loss *= 4.
+                    loss *= detgain  
+                scaler.scale(loss).backward()
+                imgshape = imgs.shape[-1]
+                if plots and ni >= 3:
+                    del imgs  
+                else:
+                    imgs = imgs.to(torch.device('cpu'), non_blocking=True)
             else:
-                imgs = imgs.to(torch.device('cpu'), non_blocking=True)  
-            
-            segimgs = segimgs.to(device, non_blocking=True)  
+                segimgs = segimgs.to(device, non_blocking=True, memory_format=mf)  
 
-            with amp.autocast(enabled=cuda):  
-                pred = model(segimgs)
+                with amp.autocast(enabled=cuda):  
+                    pred = fmodel(segimgs, tasks={'seg'})  # forward, seg head only
 # -----------------------------------------------------------------------------------------------------------
-                # Base,PSP, Lab
-                segloss = compute_seg_loss(pred[1], segtargets.to(device)) * batch_size   
-                # Bise   
-                # segloss = compute_seg_loss(pred[1][0], pred[1][1], pred[1][2], segtargets.to(device)) * batch_size    
+                    # Base,PSP, Lab
+                    segloss = seg_loss(pred[1], segtargets.to(device)) * seg_batch_size   
+                    # Bise   
+                    # segloss = compute_seg_loss(pred[1][0], pred[1][1], pred[1][2], segtargets.to(device)) * batch_size    
                 
-                # segloss = compute_seg_loss(pred[1][0], pred[1][1], segtargets.to(device)) * batch_size   
+                    # segloss = compute_seg_loss(pred[1][0], pred[1][1], segtargets.to(device)) * batch_size   
 # -----------------------------------------------------------------------------------------------------------
-                segloss *= seggain
-            scaler.scale(segloss).backward()
-            del segimgs
+                    segloss *= seggain
+                scaler.scale(segloss).backward()
+                imgshape = segimgs.shape[-1]
+                del segimgs
 
             # Optimize
             if ni % accumulate == 0:  
@@ -409,15 +457,19 @@ def train(hyp, opt, device, tb_writer=None):
 
             # Print
             if rank in [-1, 0]:
-                mloss = (mloss * i + loss_items) / (i + 1)  # update mean losses
-                msegloss = (msegloss * i + segloss.detach()/total_batch_size) / (i + 1)
+                if det:
+                    k = task_scheduler.steps['det'] - 1  # previous det steps this epoch
+                    mloss = (mloss * k + loss_items) / (k + 1)  # update mean losses
+                if seg:
+                    k = task_scheduler.steps['seg'] - 1
+                    msegloss = (msegloss * k + segloss.detach() / seg_batch_size) / (k + 1)
                 mem = '%.3gG' % (torch.cuda.memory_reserved() / 1E9 if torch.cuda.is_available() else 0)  # (GB)
                 s = ('%10s' * 2 + '%10.4g' * 7) % (
-                    '%g/%g' % (epoch, epochs - 1), mem, *mloss, msegloss, targets.shape[0], imgshape)
+                    '%g/%g' % (epoch, epochs - 1), mem, *mloss, msegloss, targets.shape[0] if det else 0, imgshape)
                 pbar.set_description(s)
 
                 # Plot
-                if plots and ni < 3:
+                if plots and ni < 3 and det:
                     f = save_dir / f'train_batch{ni}.jpg'  # filename
                     Thread(target=plot_images, args=(imgs, targets, paths, f), daemon=True).start()
                     # if tb_writer:
@@ -430,6 +482,8 @@ def train(hyp, opt, device, tb_writer=None):
             # end batch ------------------------------------------------------------------------------------------------
         # end epoch ----------------------------------------------------------------------------------------------------
 
+        dt = (time.time() - t_epoch) / nsteps * 1E3  # ms/step, compare --compile/--channels-last runs against eager
+
         # Scheduler
         lr = [x['lr'] for x in optimizer.param_groups]  # for tensorboard
         scheduler.step()  
@@ -469,8 +523,11 @@ def train(hyp, opt, device, tb_writer=None):
             tags = ['train/box_loss', 'train/obj_loss', 'train/cls_loss',  # train loss
                     'metrics/precision', 'metrics/recall', 'metrics/mAP_0.5', 'metrics/mAP_0.5:0.95',
                     'val/box_loss', 'val/obj_loss', 'val/cls_loss',  # val loss
-                    'x/lr0', 'x/lr1', 'x/lr2']  # params
-            for x, tag in zip(list(mloss[:-1]) + list(results) + lr, tags):  
+                    'x/lr0', 'x/lr1', 'x/lr2',  # params
+                    'train/det_steps', 'train/seg_steps']  # task scheduler
+            logger.info(f'Task steps: {task_scheduler}, {dt:.1f} ms/step')
+            for x, tag in zip(list(mloss[:-1]) + list(results) + lr + [task_scheduler.steps[t] for t in ('det', 'seg')],
+                              tags):
                 if tb_writer:
                     tb_writer.add_scalar(tag, x, epoch)  # tensorboard
                 if wandb_logger.wandb:
@@ -489,18 +546,17 @@ def train(hyp, opt, device, tb_writer=None):
                 ckpt = {'epoch': epoch,
                         'best_fitness': best_fitness,
                         'training_results': results_file.read_text(),
-                        'model': deepcopy(model.module if is_parallel(model) else model).half(),
-                        'ema': deepcopy(ema.ema).half(),
+                        'model': model.module if is_parallel(model) else model,  # FP16 copies made by ckpt_writer
+                        'ema': ema.ema,
                         'updates': ema.updates,
                         'optimizer': optimizer.state_dict(),
                         'wandb_id': wandb_logger.wandb_run.id if wandb_logger.wandb else None}
 
-                # Save last, best and delete
-                torch.save(ckpt, last)
-                if best_fitness == fi:
-                    torch.save(ckpt, best)
+                # Save last, best (hard link) and delete, in the background
+                ckpt_writer.save(ckpt, epoch, best=best_fitness == fi)
                 if wandb_logger.wandb:
                     if ((epoch + 1) % opt.save_period == 0 and not final_epoch) and opt.save_period != -1:
+                        ckpt_writer.wait()
                         wandb_logger.log_model(
                             last.parent, opt, epoch, fi, best_model=best_fitness == fi)
                 del ckpt
@@ -508,6 +564,8 @@ def train(hyp, opt, device, tb_writer=None):
         # end epoch ----------------------------------------------------------------------------------------------------
     # end training
     if rank in [-1, 0]:
+        ckpt_writer.wait()  # last.pt and best.pt written
+
         # Plots
         if plots:  
             plot_results(save_dir=save_dir)  # save as results.png
@@ -585,6 +643,15 @@ if __name__ == '__main__':
     parser.add_argument('--upload_dataset', action='store_true', help='Upload dataset as W&B artifact table')
     parser.add_argument('--bbox_interval', type=int, default=-1, help='Set bounding-box image logging interval for W&B')
     parser.add_argument('--save_period', type=int, default=-1, help='Log model after every "save_period" epoch')
+    parser.add_argument('--seg-batch-size', type=int, default=0, help='total seg batch size, 0 for --batch-size')
+    parser.add_argument('--seg-img-size', type=int, default=0, help='seg train crop size, 0 for train --img-size')
+    parser.add_argument('--task-ratio', nargs=2, type=float, help='det seg step ratio, default dataset batch counts')
+    parser.add_argument('--epoch-samples', type=int, default=0, help='images per epoch, 0 for det + seg dataset sizes')
+    parser.add_argument('--grad-ckpt', nargs='+', help='activation checkpointing: blocks, neck, seg, all, layer indices')
+    parser.add_argument('--compile', action='store_true', help='torch.compile the training forward and losses')
+    parser.add_argument('--channels-last', action='store_true', help='channels-last (NHWC) model and inputs')
+    parser.add_argument('--keep-ckpts', type=int, default=0, help='also keep the last N epochs as epoch*.pt')
+    parser.add_argument('--joint', action='store_true', help='one forward/backward pass for the det and seg batches')
     parser.add_argument('--artifact_alias', type=str, default="latest", help='version of dataset artifact to be used')
 
     opt = parser.parse_args()
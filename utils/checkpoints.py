@@ -0,0 +1,101 @@
+# Asynchronous training checkpoint writer
+
+import os
+import shutil
+import threading
+from copy import deepcopy
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+
+
+class CheckpointWriter:
+    """ Saves training checkpoints without stalling the training loop
+
+    save() snapshots the checkpoint dict to CPU buffers that are allocated (pinned) once and reused, with asynchronous
+    device to host copies, and returns. A background thread then waits for the copies, serialises the snapshot to a
+    temporary file and renames it to last.pt (atomic). best.pt and the kept epoch files are hard links to (copies of,
+    where links are not supported) last.pt instead of being serialised again. One save is in flight at a time, the next
+    save() or wait() waits for it and re-raises its error. Usage:
+        writer = CheckpointWriter(wdir, keep=3)  # keep epoch0.pt ... as the 3 most recent epochs
+        writer.save({'epoch': epoch, 'model': model, 'optimizer': optimizer.state_dict()}, epoch, best=True)
+        writer.wait()  # before reading the files
+    """
+
+    def __init__(self, wdir, keep=0, half=True):
+        self.wdir = Path(wdir)
+        self.last, self.best = self.wdir / 'last.pt', self.wdir / 'best.pt'
+        self.keep = keep  # epoch checkpoints to keep, 0 for last.pt and best.pt only
+        self.half = half  # FP16 model weights, as deepcopy(model).half()
+        self.pin = torch.cuda.is_available()
+        self.buffers = {}  # snapshot buffers by key path, reused across saves
+        self.thread, self.error = None, None
+
+    def snapshot(self, x, key=''):
+        # Returns x with its tensors and nn.Modules copied to the CPU buffers of key
+        if isinstance(x, nn.Module):
+            if key not in self.buffers:  # CPU copy of the module, then its state is copied in place on every save
+                m = deepcopy(x).cpu()
+                m = m.half() if self.half else m
+                self.buffers[key] = m._apply(lambda t: t.pin_memory()) if self.pin else m
+            m, sd = self.buffers[key], x.state_dict()
+            for k, t in m.state_dict().items():
+                t.copy_(sd[k], non_blocking=True)  # casts to FP16
+            return m
+        elif isinstance(x, torch.Tensor):
+            b = self.buffers.get(key)
+            if b is None or b.shape != x.shape or b.dtype != x.dtype:
+                b = self.buffers[key] = torch.empty(x.shape, dtype=x.dtype, pin_memory=self.pin)
+            return b.copy_(x.detach(), non_blocking=True)
+        elif isinstance(x, dict):
+            return {k: self.snapshot(v, f'{key}/{k}') for k, v in x.items()}
+        elif isinstance(x, (list, tuple)):
+            return type(x)(self.snapshot(v, f'{key}/{i}') for i, v in enumerate(x))
+        return x
+
+    def save(self, ckpt, epoch, best=False):
+        # Snapshots ckpt and writes it to last.pt (and best.pt) in the background
+        self.wait()
+        ckpt = self.snapshot(ckpt)
+        event = torch.cuda.Event() if self.pin else None
+        if event:
+            event.record()  # device to host copies done
+        self.thread = threading.Thread(target=self._write, args=(ckpt, epoch, best, event), daemon=True)
+        self.thread.start()
+
+    def wait(self):
+        # Waits for the save in flight, re-raises its error
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if self.error:
+            e, self.error = self.error, None
+            raise e
+
+    def _write(self, ckpt, epoch, best, event):
+        try:
+            if event:
+                event.synchronize()
+            tmp = self.last.with_suffix('.tmp')
+            torch.save(ckpt, tmp)
+            os.replace(tmp, self.last)  # atomic
+            if best:
+                self._link(self.best)
+            if self.keep:
+                self._link(self.wdir / f'epoch{epoch}.pt')
+                for f in sorted(self.wdir.glob('epoch*.pt'), key=lambda f: int(f.stem[5:]))[:-self.keep]:
+                    f.unlink()  # retention
+        except Exception as e:
+            self.error = e
+
+    def _link(self, f):
+        # Atomically points f at the contents of last.pt, by hard link or by copy
+        tmp = f.with_suffix('.tmp')
+        if tmp.exists():
+            tmp.unlink()
+        try:
+            os.link(self.last, tmp)
+        except OSError:
+            shutil.copyfile(self.last, tmp)
+        os.replace(tmp, f)
@@ -1,5 +1,6 @@
 # Dataset utils and dataloaders
 
+import atexit
 import glob
 import logging
 import math
@@ -8,9 +9,11 @@ import random
 import shutil
 import time
 from itertools import repeat
+from multiprocessing import Process
 from multiprocessing.pool import ThreadPool
+from multiprocessing.shared_memory import SharedMemory
 from pathlib import Path
-from threading import Thread
+from threading import Condition, Thread
 
 import cv2
 import numpy as np
@@ -119,6 +122,68 @@ class _RepeatSampler(object):
             yield from iter(self.sampler)
 
 
+class TaskScheduler:
+    """ Multi-task batch scheduler, replaces zip() of the per-task dataloaders
+
+    Each task has its own dataloader (batch size, image size) and sampling ratio. Loaders are cycled endlessly and an
+    epoch is epoch_samples images over all tasks. Each step draws the task furthest behind its ratio (smooth weighted
+    round-robin), so steps per task follow the ratios exactly; with joint=True each step draws one batch of every task.
+    Usage:
+        scheduler = TaskScheduler({'det': dataloader, 'seg': segloader}, {'det': 1, 'seg': 2}, epoch_samples=10000)
+        for i, batch in enumerate(scheduler):  # one epoch, batch = {task: batch}
+            pass
+        print(scheduler.steps)  # steps per task this epoch
+    """
+
+    def __init__(self, loaders, ratios=None, epoch_samples=0, joint=False):
+        self.loaders = loaders
+        self.ratios = ratios or {t: len(l) for t, l in loaders.items()}  # default: every dataset once per epoch
+        self.epoch_samples = epoch_samples or sum(len(l.sampler) for l in loaders.values())  # DDP: this rank
+        self.joint = joint
+        self.iterators = {t: iter(l) for t, l in loaders.items()}
+        self.cycles = {t: 0 for t in loaders}  # passes over each dataset
+        self.credit = {t: 0. for t in loaders}
+        self.steps, self.samples = {}, {}  # per task, this epoch
+
+    def __len__(self):  # steps per epoch (estimated)
+        bs = {t: l.batch_size for t, l in self.loaders.items()}
+        if self.joint:
+            return math.ceil(self.epoch_samples / sum(bs.values()))
+        return math.ceil(self.epoch_samples * sum(self.ratios.values()) / sum(self.ratios[t] * bs[t] for t in bs))
+
+    def next(self, task):
+        # Next batch of task, starts a new pass over its dataset (reshuffled, next DDP sampler epoch) when exhausted
+        try:
+            return next(self.iterators[task])
+        except StopIteration:
+            self.cycles[task] += 1
+            loader = self.loaders[task]
+            if hasattr(loader.sampler, 'set_epoch'):
+                loader.sampler.set_epoch(self.cycles[task])
+            self.iterators[task] = iter(loader)
+            return next(self.iterators[task])
+
+    def __iter__(self):
+        self.steps, self.samples = {t: 0 for t in self.loaders}, {t: 0 for t in self.loaders}
+        while sum(self.samples.values()) < self.epoch_samples:
+            if self.joint:
+                tasks = list(self.loaders)
+            else:
+                for t in self.credit:
+                    self.credit[t] += self.ratios[t]
+                t = max(self.credit, key=self.credit.get)
+                self.credit[t] -= sum(self.ratios.values())
+                tasks = [t]
+            batch = {t: self.next(t) for t in tasks}
+            for t in tasks:
+                self.steps[t] += 1
+                self.samples[t] += len(batch[t][0])
+            yield batch
+
+    def __str__(self):
+        return ', '.join(f'{t} {self.steps[t]} steps {self.samples[t]} images' for t in self.steps)
+
+
 class LoadImages:  # for inference
     def __init__(self, path, img_size=640, stride=32):
         p = str(Path(path).absolute())  # os-agnostic absolute path
@@ -141,6 +206,7 @@ class LoadImages:  # for inference
         self.nf = ni + nv  # number of files
         self.video_flag = [False] * ni + [True] * nv
         self.mode = 'image'
+        self.verbose = True  # print per-item progress, disabled by LoadImageBatches
         if any(videos):
             self.new_video(videos[0])  # new video
         else:
@@ -172,14 +238,17 @@ class LoadImages:  # for inference
                     ret_val, img0 = self.cap.read()
 
             self.frame += 1
-            print(f'video {self.count + 1}/{self.nf} ({self.frame}/{self.nframes}) {path}: ', end='')
+            self.s = f'video {self.count + 1}/{self.nf} ({self.frame}/{self.nframes}) {path}: '
 
         else:
             # Read image
             self.count += 1
             img0 = cv2.imread(path)  # BGR
             assert img0 is not None, 'Image Not Found ' + path
-            print(f'image {self.count}/{self.nf} {path}: ', end='')
+            self.s = f'image {self.count}/{self.nf} {path}: '
+
+        if self.verbose:
+            print(self.s, end='')
 
         # Padded resize
         img = letterbox(img0, self.img_size, stride=self.stride)[0]
@@ -199,6 +268,46 @@ class LoadImages:  # for inference
         return self.nf  # number of files
 
 
+class LoadImageBatches:  # for batched inference
+    # Groups consecutive LoadImages outputs (images or video frames) that share a letterboxed shape into one batch
+    def __init__(self, dataset, batch_size=8):
+        self.dataset = dataset
+        self.dataset.verbose = False
+        self.batch_size = batch_size
+        self.mode = 'batch'
+
+    def __iter__(self):
+        self.pending = None  # item read ahead that did not fit the previous batch
+        self.it = iter(self.dataset)
+        return self
+
+    def _read(self):
+        if self.pending is not None:
+            item, self.pending = self.pending, None
+            return item
+        path, img, img0, cap = next(self.it)
+        return path, img, img0, cap, self.dataset.mode, getattr(self.dataset, 'frame', 0), self.dataset.s
+
+    def __next__(self):
+        batch = [self._read()]  # raises StopIteration when exhausted
+        while len(batch) < self.batch_size:
+            try:
+                item = self._read()
+            except StopIteration:
+                break
+            if item[1].shape != batch[0][1].shape:  # shape change, start a new batch
+                self.pending = item
+                break
+            batch.append(item)
+
+        paths, imgs, img0s, caps, self.modes, self.frames, self.s = map(list, zip(*batch))
+        img = np.stack(imgs, 0)  # bsx3x416x416
+        return paths, img, img0s, caps
+
+    def __len__(self):
+        return len(self.dataset)
+
+
 class LoadWebcam:  # for inference
     def __init__(self, pipe='0', img_size=640, stride=32):
         self.img_size = img_size
@@ -257,11 +366,68 @@ class LoadWebcam:  # for inference
         return 0
 
 
+def parse_stream_policy(policy):
+    # 'latest', 'every-4' or 'time-0.5' -> (kind, k)
+    kind, _, k = policy.partition('-')
+    assert kind in ('latest', 'every', 'time'), f'Unknown stream policy {policy}, use latest, every-k or time-t'
+    return kind, float(k) if kind == 'time' else int(k or 1)
+
+
+def grab_frames(cap, policy, counts):
+    # Yields (success, frame, time) for the frames of an opened cv2.VideoCapture that policy keeps, counts[1] += skipped
+    kind, k = policy
+    n, t = 0, time.time()
+    while cap.isOpened():
+        n += 1
+        if not cap.grab():  # stream ended or camera error
+            return
+        if kind == 'every' and n % k or kind == 'time' and time.time() - t < k:
+            counts[1] += 1  # skipped by policy
+            continue
+        success, im = cap.retrieve()
+        t = time.time()
+        yield success, im, t
+
+
+def ring_views(shm, shape, slots):
+    # numpy views of a stream ring buffer in shared memory: header [seq, alive, read, skipped], stamps, frames
+    header = np.ndarray((4,), dtype=np.int64, buffer=shm.buf)
+    stamps = np.ndarray((slots,), dtype=np.float64, buffer=shm.buf, offset=header.nbytes)
+    frames = np.ndarray((slots, *shape), dtype=np.uint8, buffer=shm.buf, offset=header.nbytes + stamps.nbytes)
+    return header, stamps, frames
+
+
+def capture_stream(url, policy, shm, shape, slots):
+    # Decode a stream in its own process, frame seq is written to ring slot seq % slots before seq is published
+    header, stamps, frames = ring_views(shm, shape, slots)
+    cap = cv2.VideoCapture(url)
+    for success, im, t in grab_frames(cap, policy, header[2:]):
+        seq = header[0] + 1
+        j = seq % slots
+        if not success:
+            frames[j] = 0
+        elif im.shape == frames[j].shape:
+            frames[j] = im
+        else:  # resolution changed mid-stream
+            frames[j] = cv2.resize(im, (shape[1], shape[0]))
+        stamps[j] = t
+        header[0] = seq
+        header[2] += 1
+    header[1] = 0
+
+
 class LoadStreams:  # multiple IP or RTSP cameras
-    def __init__(self, sources='streams.txt', img_size=640, stride=32):
+    # policy: per-stream frame drop policy, one for all or a list, 'latest' (keep newest), 'every-k' (retrieve every k-th
+    # frame) or 'time-t' (retrieve at most one frame every t seconds). ready=True returns only streams with a new frame,
+    # batched, instead of every stream's last frame. headless=True skips the cv2.waitKey() GUI poll. processes=True
+    # decodes each stream in its own process into a shared memory ring buffer of slots frames, read here without copies
+    def __init__(self, sources='streams.txt', img_size=640, stride=32, policy='every-4', ready=False, headless=False,
+                 processes=False, slots=4):
         self.mode = 'stream'
         self.img_size = img_size
         self.stride = stride
+        self.ready_only = ready
+        self.headless = headless
 
         if os.path.isfile(sources):
             with open(sources, 'r') as f:
@@ -270,10 +436,20 @@ class LoadStreams:  # multiple IP or RTSP cameras
             sources = [sources]
 
         n = len(sources)
+        policies = [policy] * n if isinstance(policy, str) else list(policy)
+        assert len(policies) in (1, n), f'{len(policies)} stream policies for {n} streams'
+        self.policies = [parse_stream_policy(x) for x in (policies * n if len(policies) == 1 else policies)]
         self.imgs = [None] * n
         self.sources = [clean_str(x) for x in sources]  # clean source names for later
+        self.cond = Condition()  # guards per-stream state below, notified on every new frame
+        self.seq, self.consumed, self.stamp = [0] * n, [0] * n, [0.] * n  # frame counter, last consumed, capture time
+        self.alive = [True] * n
+        self.counts = np.zeros((n, 4))  # per stream: retrieved, skipped by policy, dropped unconsumed, consumed
+        self.latency = np.zeros((n, 2))  # per stream: capture -> batch latency sum, max (seconds)
+        self.pool = ThreadPool(min(n, 8)) if n > 1 else None  # letterbox workers
+        self.rings, self.shms = [], []  # (header, stamps, frames) and SharedMemory per stream if processes
         for i, s in enumerate(sources):
-            # Start the thread to read frames from the video stream
+            # Start the thread (or process) to read frames from the video stream
             print(f'{i + 1}/{n}: {s}... ', end='')
             url = eval(s) if s.isnumeric() else s
             if 'youtube.com/' in url or 'youtu.be/' in url:  # if source is YouTube video
@@ -287,9 +463,22 @@ class LoadStreams:  # multiple IP or RTSP cameras
             self.fps = cap.get(cv2.CAP_PROP_FPS) % 100
 
             _, self.imgs[i] = cap.read()  # guarantee first frame
-            thread = Thread(target=self.update, args=([i, cap]), daemon=True)
-            print(f' success ({w}x{h} at {self.fps:.2f} FPS).')
-            thread.start()
+            self.seq[i], self.stamp[i] = 1, time.time()
+            if processes:  # the capture process re-opens the stream and owns decoding from here on
+                cap.release()
+                shape = self.imgs[i].shape
+                shm = SharedMemory(create=True, size=8 * (4 + slots) + slots * int(np.prod(shape)))
+                atexit.register(shm.unlink)
+                ring = ring_views(shm, shape, slots)
+                ring[0][:] = 1, 1, 1, 0  # seq, alive, read, skipped
+                ring[1][1], ring[2][1] = self.stamp[i], self.imgs[i]
+                self.rings.append(ring)
+                self.shms.append(shm)  # keep mappings open
+                worker = Process(target=capture_stream, args=(url, self.policies[i], shm, shape, slots), daemon=True)
+            else:
+                worker = Thread(target=self.update, args=([i, cap]), daemon=True)
+            print(f' success ({w}x{h} at {self.fps:.2f} FPS, {policies[i % len(policies)]}).')
+            worker.start()
         print('')  # newline
 
         # check for common shapes
@@ -299,17 +488,28 @@ class LoadStreams:  # multiple IP or RTSP cameras
             print('WARNING: Different stream shapes detected. For optimal performance supply similarly-shaped streams.')
 
     def update(self, index, cap):
-        # Read next stream frame in a daemon thread
-        n = 0
-        while cap.isOpened():
-            n += 1
-            # _, self.imgs[index] = cap.read()
-            cap.grab()
-            if n == 4:  # read every 4th frame
-                success, im = cap.retrieve()
+        # Read next stream frame in a daemon thread. grab() is paced by the stream itself, so there is no sleep here
+        for success, im, t in grab_frames(cap, self.policies[index], self.counts[index]):
+            with self.cond:
                 self.imgs[index] = im if success else self.imgs[index] * 0
-                n = 0
-            time.sleep(1 / self.fps)  # wait time
+                self.counts[index, 0] += 1
+                self.counts[index, 2] += self.consumed[index] < self.seq[index]  # previous frame never used
+                self.seq[index] += 1
+                self.stamp[index] = t
+                self.cond.notify_all()
+        with self.cond:
+            self.alive[index] = False
+            self.cond.notify_all()
+
+    def poll(self):
+        # Refresh per-stream state from the capture process ring buffers, frames are views into shared memory
+        for i, (header, stamps, frames) in enumerate(self.rings):
+            seq = int(header[0])
+            if seq > self.seq[i]:
+                self.counts[i, 2] += seq - max(self.seq[i], self.consumed[i] + 1)  # overwritten before use
+                self.seq[i], self.imgs[i], self.stamp[i] = seq, frames[seq % len(frames)], stamps[seq % len(frames)]
+            self.alive[i] = bool(header[1])
+            self.counts[i, :2] = header[2:]
 
     def __iter__(self):
         self.count = -1
@@ -317,13 +517,36 @@ class LoadStreams:  # multiple IP or RTSP cameras
 
     def __next__(self):
         self.count += 1
-        img0 = self.imgs.copy()
-        if cv2.waitKey(1) == ord('q'):  # q to quit
+        if not self.headless and cv2.waitKey(1) == ord('q'):  # q to quit
             cv2.destroyAllWindows()
             raise StopIteration
 
+        with self.cond:
+            self.poll()
+            if self.ready_only:  # wait until at least one stream has a frame that was not consumed yet
+                new = lambda: [i for i, (a, b) in enumerate(zip(self.seq, self.consumed)) if a > b]
+                if self.rings:
+                    while not new() and any(self.alive):
+                        time.sleep(0.001)
+                        self.poll()
+                else:
+                    self.cond.wait_for(lambda: new() or not any(self.alive))
+                self.ready = new()
+                if not self.ready:  # all streams ended
+                    raise StopIteration
+            else:
+                self.ready = list(range(len(self.imgs)))
+            img0 = [self.imgs[i] for i in self.ready]
+            t = time.time()
+            for i in self.ready:
+                if self.consumed[i] < self.seq[i]:
+                    self.counts[i, 3] += 1
+                    self.latency[i] = self.latency[i, 0] + t - self.stamp[i], max(self.latency[i, 1], t - self.stamp[i])
+                self.consumed[i] = self.seq[i]
+
         # Letterbox
-        img = [letterbox(x, self.img_size, auto=self.rect, stride=self.stride)[0] for x in img0]
+        f = lambda x: letterbox(x, self.img_size, auto=self.rect, stride=self.stride)[0]
+        img = self.pool.map(f, img0) if self.pool and len(img0) > 1 else [f(x) for x in img0]
 
         # Stack
         img = np.stack(img, 0)
@@ -332,7 +555,15 @@ class LoadStreams:  # multiple IP or RTSP cameras
         img = img[:, :, :, ::-1].transpose(0, 3, 1, 2)  # BGR to RGB, to bsx3x416x416
         img = np.ascontiguousarray(img)
 
-        return self.sources, img, img0, None
+        return [self.sources[i] for i in self.ready], img, img0, None
+
+    def stats(self):
+        # Returns a printable per-stream summary of frame counters and capture -> batch latency
+        s = ''
+        for name, (read, skipped, dropped, used), (lsum, lmax) in zip(self.sources, self.counts, self.latency):
+            s += f'{name}: {read:.0f} read, {skipped:.0f} skipped, {dropped:.0f} dropped, {used:.0f} used, ' \
+                 f'latency {1E3 * lsum / max(used, 1):.1f}/{1E3 * lmax:.1f}ms mean/max\n'
+        return s.rstrip()
 
     def __len__(self):
         return 0  # 1E12 frames = 32 streams at 30 FPS for 30 years
@@ -848,6 +1079,20 @@ def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scale
     return img, ratio, (dw, dh)
 
 
+def tile_image(img, size=640, overlap=0.2, stride=32, color=(114, 114, 114)):
+    # Split an HWC image at native resolution into overlapping size x size tiles, padding right/bottom to fit
+    # Returns tiles (n,size,size,c) and their (x, y) offsets, all multiples of stride
+    h, w = img.shape[:2]
+    hp, wp = [max(size, math.ceil(x / stride) * stride) for x in (h, w)]
+    if (hp, wp) != (h, w):
+        img = cv2.copyMakeBorder(img, 0, hp - h, 0, wp - w, cv2.BORDER_CONSTANT, value=color)
+    step = max(stride, int(size * (1 - overlap)) // stride * stride)
+    xs = list(range(0, wp - size, step)) + [wp - size]
+    ys = list(range(0, hp - size, step)) + [hp - size]
+    offsets = [(x, y) for y in ys for x in xs]
+    return np.stack([img[y:y + size, x:x + size] for x, y in offsets], 0), offsets
+
+
 def random_perspective(img, targets=(), segments=(), degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0,
                        border=(0, 0)):
     # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(.1, .1), scale=(.9, 1.1), shear=(-10, 10))
@@ -509,18 +509,97 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
     return output
 
 
-def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_optimizer()
+def batched_non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False,
+                                multi_label=False, labels=(), max_det=300):
+    """Runs Non-Maximum Suppression (NMS) on inference results of all images at once, no per-image Python loop
+
+    Same detections as non_max_suppression(): candidates of every image go through one torchvision.ops.nms() call with
+    boxes offset by image and class (in float64, so the offsets are exact).
+
+    Returns:
+         (bs,max_det,6) tensor of detections [xyxy, conf, cls] padded with zeros, (bs,) tensor of detection counts
+    """
+
+    bs, _, no = prediction.shape
+    nc = no - 5  # number of classes
+    max_wh = 4096  # (pixels) maximum box width and height
+    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms() per image
+    multi_label &= nc > 1  # multiple labels per box
+    device = prediction.device
+    by_image = lambda b: (b * len(b) + torch.arange(len(b), device=device)).argsort()  # stable sort by image index
+
+    bi, ai = (prediction[..., 4] > conf_thres).nonzero(as_tuple=False).T  # candidates, image index
+    x = prediction[bi, ai]
+
+    # Cat apriori labels if autolabelling, after the candidates of their image
+    if labels and any(len(l) for l in labels):
+        v = torch.zeros((sum(len(l) for l in labels), no), device=device)
+        l = torch.cat(list(labels), 0)
+        v[:, :4] = l[:, 1:5]  # box
+        v[:, 4] = 1.0  # conf
+        v[range(len(l)), l[:, 0].long() + 5] = 1.0  # cls
+        vi = torch.cat([torch.full((len(l),), i, device=device) for i, l in enumerate(labels)])
+        bi, x = torch.cat((bi, vi)), torch.cat((x, v), 0)
+        i = by_image(bi)
+        bi, x = bi[i], x[i]
+
+    # Compute conf, detections matrix nx6 (xyxy, conf, cls)
+    x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+    box = xywh2xyxy(x[:, :4])
+    if multi_label:
+        i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
+        x, bi = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1), bi[i]
+    else:  # best class only
+        conf, j = x[:, 5:].max(1, keepdim=True)
+        i = conf.view(-1) > conf_thres
+        x, bi = torch.cat((box, conf, j.float()), 1)[i], bi[i]
+
+    # Filter by class
+    if classes is not None:
+        i = (x[:, 5:6] == torch.tensor(classes, device=device)).any(1)
+        x, bi = x[i], bi[i]
+
+    # Excess boxes, keep the max_nms most confident of each image
+    n = torch.bincount(bi, minlength=bs)  # boxes per image
+    if n.max() > max_nms:
+        i = x[:, 4].argsort(descending=True)
+        i = i[by_image(bi[i])]  # by image, then by confidence
+        i = i[torch.arange(len(i), device=device) - (n.cumsum(0) - n)[bi[i]] < max_nms]
+        x, bi = x[i], bi[i]
+
+    # Batched NMS, one call for all images and classes
+    c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
+    boxes = (x[:, :4] + c).double() + bi[:, None].double() * (max_wh * (nc + 2))  # offset by class, then image
+    i = torchvision.ops.nms(boxes, x[:, 4].double(), iou_thres)  # NMS, by decreasing score
+    i = i[by_image(bi[i])]  # by image, then by score
+    x, bi = x[i], bi[i]
+
+    # Pad to (bs,max_det,6)
+    n = torch.bincount(bi, minlength=bs)
+    r = torch.arange(len(bi), device=device) - (n.cumsum(0) - n)[bi]  # rank within image
+    k = r < max_det  # limit detections
+    output = x.new_zeros((bs, max_det, 6))
+    output[bi[k], r[k]] = x[k]
+    return output, n.clamp(max=max_det)
+
+
+def strip_optimizer(f='best.pt', s='', tasks=None):  # from utils.general import *; strip_optimizer()
     # Strip optimizer from 'f' to finalize training, optionally save as 's'
+    # tasks={'det'} or {'seg'} also prunes the layers only the other head needs (single-task checkpoint)
     x = torch.load(f, map_location=torch.device('cpu'))
     if x.get('ema'):
         x['model'] = x['ema']  # replace model with ema
+    if tasks:
+        x['model'].select_tasks(tasks)
     for k in 'optimizer', 'training_results', 'wandb_id', 'ema', 'updates':  # keys
         x[k] = None
     x['epoch'] = -1
     x['model'].half()  # to FP16
     for p in x['model'].parameters():
         p.requires_grad = False
-    torch.save(x, s or f)
+    tmp = Path(s or f).with_suffix('.tmp')
+    torch.save(x, tmp)
+    os.replace(tmp, s or f)  # atomic, and leaves other hard links to f (best.pt, epoch*.pt) unchanged
     mb = os.path.getsize(s or f) / 1E6  # filesize
     print(f"Optimizer stripped from {f},{(' saved as %s,' % s) if s else ''} {mb:.1f}MB")
 
@@ -0,0 +1,97 @@
+# Staged pipeline executor for inference
+
+import queue
+import threading
+import time
+
+_STOP = object()  # end-of-stream marker
+
+
+class _Error:
+    # Wraps an exception raised inside a stage so it travels downstream in order and is re-raised by the consumer
+    def __init__(self, e):
+        self.e = e
+
+
+class Pipeline:
+    """ Runs a source iterator through a chain of stages connected by bounded queues
+
+    Each stage is a (name, fn, workers) tuple and runs in its own worker thread(s), so e.g. decoding of item N+1 and
+    writing of item N-1 overlap the work done on item N. Queues are bounded by maxsize (backpressure) and every stage
+    hands its results downstream in source order, even with several workers. Usage:
+        pipeline = Pipeline(iter(dataset), [('infer', infer, 1), ('post', post, 4), ('write', write, 1)])
+        for y in pipeline:
+            pass
+        print(pipeline.stats())
+    """
+
+    def __init__(self, source, stages, maxsize=4):
+        self.source = source
+        self.stages = stages
+        self.q = [queue.Queue(maxsize=maxsize) for _ in range(len(stages) + 1)]  # q[k] feeds stage k
+        self.next = [0] * len(stages)  # next sequence number each stage may hand downstream
+        self.cond = [threading.Condition() for _ in stages]
+        self.depth = [[0, 0, 0] for _ in stages]  # input queue depth sum, samples, max
+        self.busy = [0.] * len(stages)  # seconds spent inside each stage fn
+
+        threading.Thread(target=self._feed, daemon=True).start()
+        for k, (_, _, workers) in enumerate(stages):
+            for _ in range(max(workers, 1)):
+                threading.Thread(target=self._work, args=(k,), daemon=True).start()
+
+    def _feed(self):
+        seq = 0
+        try:
+            for x in self.source:
+                self.q[0].put((seq, x))  # blocks while the first stage is saturated
+                seq += 1
+        except Exception as e:
+            self.q[0].put((seq, _Error(e)))
+            seq += 1
+        self.q[0].put((seq, _STOP))
+
+    def _put(self, k, seq, x):
+        # Hand x downstream once every item before it has been handed downstream (preserves source order)
+        with self.cond[k]:
+            self.cond[k].wait_for(lambda: self.next[k] >= seq)
+            if self.next[k] > seq:  # _STOP already forwarded by a sibling worker
+                return
+            self.q[k + 1].put((seq, x))
+            self.next[k] += 1
+            self.cond[k].notify_all()
+
+    def _work(self, k):
+        _, fn, _ = self.stages[k]
+        while True:
+            n = self.q[k].qsize()
+            d = self.depth[k]
+            d[0], d[1], d[2] = d[0] + n, d[1] + 1, max(d[2], n)
+            seq, x = self.q[k].get()
+            if x is _STOP:
+                self._put(k, seq, x)
+                self.q[k].put((seq, x))  # let sibling workers see it too
+                return
+            if not isinstance(x, _Error):
+                t = time.time()
+                try:
+                    x = fn(x)
+                except Exception as e:
+                    x = _Error(e)
+                self.busy[k] += time.time() - t
+            self._put(k, seq, x)
+
+    def __iter__(self):
+        while True:
+            _, x = self.q[-1].get()
+            if x is _STOP:
+                return
+            if isinstance(x, _Error):
+                raise x.e
+            yield x
+
+    def stats(self):
+        # Returns a printable per-stage summary of input queue depth (mean/max) and busy time
+        s = []
+        for (name, _, workers), (dsum, n, dmax), busy in zip(self.stages, self.depth, self.busy):
+            s.append(f'{name}[{workers}] depth {dsum / max(n, 1):.1f}/{dmax} busy {busy:.2f}s')
+        return 'Pipeline queues (mean/max): ' + ', '.join(s)
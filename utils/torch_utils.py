@@ -37,6 +37,21 @@ def torch_distributed_zero_first(local_rank: int):
         torch.distributed.barrier()
 
 
+@contextmanager
+def frozen_bn_stats(model):
+    # Context in which BatchNorm layers of model normalize with batch statistics but leave their running statistics
+    # unchanged, e.g. for the second forward of an activation checkpointed layer
+    bn = [m for m in model.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    momentum = [m.momentum for m in bn]
+    for m in bn:
+        m.momentum = 0.
+    try:
+        yield
+    finally:
+        for m, x in zip(bn, momentum):
+            m.momentum = x
+
+
 def init_torch_seeds(seed=0):
     # Speed-reproducibility tradeoff https://pytorch.org/docs/stable/notes/randomness.html
     torch.manual_seed(seed)
@@ -186,6 +201,7 @@ def fuse_conv_and_bn(conv, bn):
                           kernel_size=conv.kernel_size,
                           stride=conv.stride,
                           padding=conv.padding,
+                          dilation=conv.dilation,
                           groups=conv.groups,
                           bias=True).requires_grad_(False).to(conv.weight.device)
 
@@ -202,6 +218,25 @@ def fuse_conv_and_bn(conv, bn):
     return fusedconv
 
 
+def quantize_conv2d(model, batches=(), engine='x86'):
+    # Converts every Conv2d of model in place to QuantStub -> INT8 Conv2d -> DeQuantStub, calibrating activation ranges
+    # on batches. With no batches the structure is built for load_state_dict() of a previously quantized model
+    from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, prepare, convert
+    torch.backends.quantized.engine = engine
+    qconfig = get_default_qconfig(engine)
+    for m in list(model.modules()):
+        for k, c in m.named_children():
+            if type(c) is nn.Conv2d:
+                q = nn.Sequential(QuantStub(), c, DeQuantStub())
+                q.qconfig = qconfig
+                setattr(m, k, q)
+    prepare(model, inplace=True)
+    with torch.no_grad():
+        for x in batches:  # calibrate
+            model(x)
+    return convert(model, inplace=True)
+
+
 def model_info(model, verbose=False, img_size=640):
     # Model information. img_size may be int or list, i.e. img_size=640 or img_size=[640, 320]
     n_p = sum(x.numel() for x in model.parameters())  # number parameters
@@ -294,10 +329,11 @@ class ModelEMA:
             d = self.decay(self.updates)
 
             msd = model.module.state_dict() if is_parallel(model) else model.state_dict()  # model state_dict
-            for k, v in self.ema.state_dict().items():
-                if v.dtype.is_floating_point:
-                    v *= d
-                    v += (1. - d) * msd[k].detach()
+            esd = self.ema.state_dict()
+            k = [k for k, v in esd.items() if v.dtype.is_floating_point]
+            v, m = [esd[x] for x in k], [msd[x].detach() for x in k]
+            torch._foreach_mul_(v, d)  # multi-tensor kernels instead of a Python loop of small ones
+            torch._foreach_add_(v, m, alpha=1. - d)
 
     def update_attr(self, model, include=(), exclude=('process_group', 'reducer')):
         # Update EMA attributes